@@ -8,25 +8,47 @@ One option is to do a select from the table within a try except block and analys
 However, a more elegant solution is to try to create the table 'if not exists' with a dummy field name,
 and checking if the table got created. Does require CREATE permission in the schema. This example is in
 Snowflake but the method will work in any database.
+
+That takes several statements and a running warehouse for every table. To check many tables, e.g. hundreds
+before each pipeline run, tables_exist checks a whole list with one SHOW TERSE TABLES per schema. SHOW is a
+metadata-only command, so it needs no warehouse and no CREATE permission. The tables of each schema are cached
+for a TTL, so checks against the same schema within the TTL make no round trip at all. SHOW TERSE TABLES only
+lists tables: views and external tables have their own SHOW commands, so tables_exist reports them as not
+existing.
 """
 
 import snowflake.connector
-import pandas as pd
-import csv
+import threading
+import time
 
-from snowflake.connector.pandas_tools import write_pandas
+from df_staging import quote_ident
+from snowflake.connector.errors import ProgrammingError
 
 __author__ = "Arindam Sinha"
 __license__ = "GPL"
 __version__ = "1.0.0"
 __status__ = "Prototype"
 
-# Create snowflake connection
-def create_conn():
+# Seconds the tables of a schema are served from the cache before SHOW is run again
+TABLE_CACHE_TTL = 300
+# Rows returned by one SHOW command. Schemas with more tables are read a page at a time
+SHOW_PAGE_ROWS = 10000
+# Snowflake error for a database or schema that doesn't exist or isn't visible to the role
+OBJECT_NOT_FOUND_ERRNO = 2003
+
+# Names of the tables in each schema by (database, schema), with the time they expire
+_table_cache = {}
+_table_cache_lock = threading.Lock()
+
+
+# Create snowflake connection. conn_kwargs are more connection parameters, e.g. the warehouse, database and
+# schema for a load
+def create_conn(**conn_kwargs):
     contx = snowflake.connector.connect(
           account='<Snowflake account>',
           user='<Username>',
-          password='<Password>'
+          password='<Password>',
+          **conn_kwargs
           )
 
     cursor = contx.cursor()
@@ -34,48 +56,157 @@ def create_conn():
     return contx, cursor
 
 
-if __name__ == "__main__":
-    curr = ctx = None
+# Split a qualified name like db.schema.table into its parts, leaving dots in quoted identifiers alone
+def split_ident_parts(qual_nm):
+    parts = ['']
+    in_quotes = False
 
-    try:
-        ctx, curr = create_conn()
+    for ch in qual_nm:
+        if ch == '"':
+            in_quotes = not in_quotes
+        if ch == '.' and not in_quotes:
+            parts.append('')
+        else:
+            parts[-1] += ch
 
-        curr.execute("CREATE WAREHOUSE IF NOT EXISTS tiny_warehouse "
-                              "WITH WAREHOUSE_SIZE = XSMALL, AUTO_SUSPEND=60")
-        curr.execute("CREATE DATABASE IF NOT EXISTS testdb")
-        curr.execute("USE DATABASE testdb")
-        curr.execute("CREATE SCHEMA IF NOT EXISTS testschema")
+    return parts
 
-        curr.execute("USE WAREHOUSE tiny_warehouse")
-        curr.execute("USE DATABASE testdb")
-        curr.execute("USE SCHEMA testdb.testschema")
 
-        # Now try to create the table with a dummy field
-        curr.execute("CREATE TABLE IF NOT EXISTS testschema.testtable (dummy_table_exist_check int)")
+# Get the name Snowflake stores for an identifier. Unquoted identifiers are stored in upper case, quoted ones
+# exactly as written
+def normalize_ident(ident):
+    ident = ident.strip()
 
-        # Execute a SELECT to get the field names
-        res = curr.execute("SELECT * FROM testschema.testtable LIMIT 1")
+    if len(ident) >= 2 and ident.startswith('"') and ident.endswith('"'):
+        return ident[1:-1].replace('""', '"')
 
-        # If the first column name matches the dummy field name, the table didn't exist
-        if res.description[0][0] == 'DUMMY_TABLE_EXIST_CHECK':
-            table_exists = False
-        else:
-            table_exists = True
+    return ident.upper()
+
+
+# Split a table name into its normalized database, schema and table. Names that aren't fully qualified take
+# the database and schema given
+def split_table_name(tbl_nm, db_nm=None, schm_nm=None):
+    parts = [normalize_ident(part) for part in split_ident_parts(tbl_nm)]
+
+    if len(parts) == 3:
+        return tuple(parts)
+    if len(parts) == 2 and db_nm:
+        return normalize_ident(db_nm), parts[0], parts[1]
+    if len(parts) == 1 and db_nm and schm_nm:
+        return normalize_ident(db_nm), normalize_ident(schm_nm), parts[0]
+
+    raise ValueError(f"Table name '{tbl_nm}' is not fully qualified and no database or schema was given")
+
+
+# Get the names of all the tables in a schema with SHOW TERSE TABLES, a page of SHOW_PAGE_ROWS at a time.
+# A schema that doesn't exist has no tables
+def show_schema_tables(curr, db_nm, schm_nm):
+    tbl_nms = set()
+    last_nm = None
+
+    while True:
+        show_cmd = f"SHOW TERSE TABLES IN SCHEMA {quote_ident(db_nm)}.{quote_ident(schm_nm)} LIMIT {SHOW_PAGE_ROWS}"
+        if last_nm is not None:
+            show_cmd += " FROM '" + last_nm.replace("'", "''") + "'"
+
+        try:
+            res = curr.execute(show_cmd)
+        except ProgrammingError as ex:
+            if ex.errno == OBJECT_NOT_FOUND_ERRNO:
+                return tbl_nms
+            raise ex
+
+        name_col = [col[0].lower() for col in res.description].index('name')
+        rows = res.fetchall()
+        tbl_nms.update(row[name_col] for row in rows)
+
+        if len(rows) < SHOW_PAGE_ROWS:
+            return tbl_nms
+
+        last_nm = rows[-1][name_col]
 
-        if table_exists:
-            print("Table exists.")
-            # Do something
-        else:
-            print("Table doesn't exist.")
 
-            # Drop the dummy table
-            curr.execute("DROP TABLE testschema.testtable")
+# Get the names of the tables in a schema, from the cache if they were read less than ttl seconds ago
+def get_schema_tables(curr, db_nm, schm_nm, ttl=TABLE_CACHE_TTL):
+    key = (db_nm, schm_nm)
 
-            # Do something else
+    with _table_cache_lock:
+        cached = _table_cache.get(key)
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
 
-        curr.execute("DROP WAREHOUSE IF EXISTS tiny_warehouse")
+    tbl_nms = show_schema_tables(curr, db_nm, schm_nm)
+
+    with _table_cache_lock:
+        _table_cache[key] = (tbl_nms, time.monotonic() + ttl)
+
+    return tbl_nms
+
+
+# Check whether each of a list of tables exists, e.g. ['testdb.testschema.testtable', 'testdb.s2."MixedCase"'].
+# One SHOW is run per schema that isn't in the cache, however many of its tables are checked. Only tables are
+# found, a view or external table of the name is reported as not existing.
+# Returns a dictionary of table name to True or False
+def tables_exist(curr, tbl_nms, db_nm=None, schm_nm=None, ttl=TABLE_CACHE_TTL):
+    split_nms = {tbl_nm: split_table_name(tbl_nm, db_nm, schm_nm) for tbl_nm in tbl_nms}
+
+    schema_tables = {}
+    for tbl_db, tbl_schm, _ in split_nms.values():
+        if (tbl_db, tbl_schm) not in schema_tables:
+            schema_tables[(tbl_db, tbl_schm)] = get_schema_tables(curr, tbl_db, tbl_schm, ttl)
+
+    return {tbl_nm: tbl in schema_tables[(tbl_db, tbl_schm)] for tbl_nm, (tbl_db, tbl_schm, tbl) in split_nms.items()}
+
+
+# Drop cached tables, e.g. after creating or dropping a table. Drops a schema, a database or everything
+def invalidate_table_cache(db_nm=None, schm_nm=None):
+    with _table_cache_lock:
+        for key in list(_table_cache):
+            if (db_nm is None or key[0] == normalize_ident(db_nm)) and \
+                    (schm_nm is None or key[1] == normalize_ident(schm_nm)):
+                del _table_cache[key]
+
+
+# Check if one table exists by trying to create it 'if not exists' with a dummy field. Works in any database
+# but needs CREATE permission and, in Snowflake, a running warehouse for the SELECT
+def table_exists_by_create(curr, schm_nm, tbl_nm):
+    # Now try to create the table with a dummy field
+    curr.execute(f"CREATE TABLE IF NOT EXISTS {schm_nm}.{tbl_nm} (dummy_table_exist_check int)")
+
+    # Execute a SELECT to get the field names
+    res = curr.execute(f"SELECT * FROM {schm_nm}.{tbl_nm} LIMIT 1")
+
+    # If the first column name matches the dummy field name, the table didn't exist
+    if res.description[0][0] == 'DUMMY_TABLE_EXIST_CHECK':
+        # Drop the dummy table
+        curr.execute(f"DROP TABLE {schm_nm}.{tbl_nm}")
+        return False
+
+    return True
+
+
+if __name__ == "__main__":
+    curr = ctx = None
+
+    try:
+        ctx, curr = create_conn()
+
+        curr.execute("CREATE DATABASE IF NOT EXISTS testdb")
+        curr.execute("CREATE SCHEMA IF NOT EXISTS testdb.testschema")
+
+        # All the tables are checked with one SHOW for testschema and one for otherschema. No warehouse needed
+        table_names = ['testdb.testschema.testtable', 'testdb.testschema.othertable', 'testdb.otherschema.testtable']
+        for table_name, table_exists in tables_exist(curr, table_names).items():
+            if table_exists:
+                print(f"Table {table_name} exists.")
+                # Do something
+            else:
+                print(f"Table {table_name} doesn't exist.")
+                # Do something else
     except Exception as ex:
         print(f"Failed: {ex}")
     finally:
-        curr.close()
-        ctx.close()
+        if curr is not None:
+            curr.close()
+        if ctx is not None:
+            ctx.close()
@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+
+"""df_staging.py: Encode a Pandas dataframe in chunks for a bulk load into a data warehouse."""
+
+"""
+The parts of a fast dataframe load that don't depend on the warehouse, shared by fast_save_df_to_redshift.py
+and fast_save_df_to_snowflake.py:
+- Encoding a chunk as CSV (written by pandas or pyarrow) compressed with gzip at any level, zstd, bzip2 or lzop,
+  or as Parquet, and picking the fastest encoding for the link to the stage from a sample of the rows
+- Handing the dataframe to the pool workers by row offsets, inherited on fork or from Arrow buffers in shared
+  memory, so it is never pickled and copied into every worker
+- Planning the chunks from the number of files the warehouse loads at once and the measured compressed size of
+  a sample of the rows
+- Metrics of each stage and chunk, as JSON lines or through a StatsD or Prometheus style hook
+- Helpers both warehouses need: the ID of a load run, the retries of an upload and quoting of identifiers
+"""
+
+# Requires installation of pyarrow. Staging CSV files with zstd also requires zstandard, and with lzop the
+# lzop command line tool
+# pip install pyarrow
+# pip install zstandard
+
+import bz2
+import contextlib
+import gzip
+import importlib.util
+import io
+import json
+import math
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+import pandas as pd
+import csv
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+from multiprocessing import shared_memory
+
+__author__ = "Arindam Sinha"
+__license__ = "GPL"
+__version__ = "1.0.0"
+__status__ = "Prototype"
+
+# Source data the pool workers read their chunks from. Only row offsets are sent to the workers, so the
+# dataframe is never pickled and copied into every worker process. A dictionary of sources by job when a batch
+# of dataframes shares the pool
+_chunk_src = None
+_chunk_shm = None
+
+# Where the metrics of a load go, set with configure_metrics. JSON lines are written to metrics path (stdout
+# if None) and each numeric field is also passed to the hook, if there is one
+_metrics_cfg = {'path': None, 'hook': None}
+_metrics_lock = threading.Lock()
+
+# Rows encoded to estimate the compressed size of a row
+SAMPLE_ROWS = 10000
+
+# Rough size of the Arrow record batches the dataframe is written to shared memory in
+SHM_BATCH_BYTES = 64 * 1024 * 1024
+
+# Times an upload of a chunk is retried before the chunk is given up on
+UPLOAD_RETRIES = 3
+
+# Values of pd.api.types.infer_dtype for object columns that can be staged as Parquet
+PARQUET_OBJECT_TYPES = ('string', 'empty', 'boolean', 'integer', 'floating', 'decimal', 'date', 'datetime')
+
+# Codecs CSV chunks can be compressed with, with the file extension of each. A level can be given after the name,
+# e.g. 'gzip-1' or 'zstd-9'. Each loader maps them to the compression option of its COPY
+CSV_CODECS = {'gzip': '.gz', 'bzip2': '.bz2', 'zstd': '.zst', 'lzop': '.lzo', 'none': '.csv'}
+# Codecs Parquet chunks can be compressed with. Redshift and Snowflake COPY can read all of them
+PARQUET_CODECS = ('snappy', 'gzip', 'zstd', 'none')
+# Codec used for each staging format if none is given
+DEFAULT_CODECS = {'csv': 'gzip', 'arrow_csv': 'gzip', 'parquet': 'snappy'}
+# Staging formats and codecs tried by the auto mode, if their packages are installed
+AUTO_CANDIDATES = [('csv', 'gzip'), ('arrow_csv', 'gzip-1'), ('arrow_csv', 'gzip-6'), ('arrow_csv', 'zstd-3'),
+                   ('arrow_csv', 'lzop'), ('arrow_csv', 'none'), ('parquet', 'snappy'), ('parquet', 'zstd')]
+
+
+# Create the ID of a load run. Each run stages its files under its own prefix or path, so loads running at the
+# same time into one bucket or stage never touch each other's files, and COPY only sees the files of its run
+def new_run_id():
+    return f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}-{uuid.uuid4().hex[:8]}"
+
+
+# Quote an identifier, e.g. a column name, so that names with spaces, lower case letters or reserved words work.
+# Redshift and Snowflake both quote with double quotes, doubling any in the name
+def quote_ident(ident):
+    return '"' + str(ident).replace('"', '""') + '"'
+
+
+# Set where metrics go. path is a file that JSON lines are appended to, stdout if None. hook is called as
+# hook(metric_name, value, tags) for every numeric field, e.g. to send them to StatsD or a Prometheus client:
+# configure_metrics(hook=lambda name, value, tags: statsd.gauge(f'redshift_load.{name}', value))
+def configure_metrics(path=None, hook=None):
+    _metrics_cfg.update({'path': path, 'hook': hook})
+
+
+# Emit one metrics record, e.g. emit_metric('stage', stage='copy', secs=12.3, table='trades'). Numeric fields
+# go to the hook as '<event>.<field>' (or '<event>.<stage>.<field>' for stages), the rest are its tags
+def emit_metric(event, **fields):
+    record = {'ts': round(time.time(), 3), 'event': event, **fields}
+
+    with _metrics_lock:
+        if _metrics_cfg['path'] is None:
+            print(json.dumps(record, default=str), flush=True)
+        else:
+            with open(_metrics_cfg['path'], 'a') as metrics_file:
+                metrics_file.write(json.dumps(record, default=str) + '\n')
+
+    hook = _metrics_cfg['hook']
+    if hook is not None:
+        tags = {k: v for k, v in fields.items() if not isinstance(v, (int, float)) or isinstance(v, bool)}
+        name_pref = f"{event}.{fields['stage']}" if 'stage' in fields else event
+        for k, v in fields.items():
+            if k not in tags:
+                hook(f'{name_pref}.{k}', v, tags)
+
+
+# Time one stage of a load and emit its metrics when it ends, with status 'failed' and the error if it raises.
+# The stage can add fields such as rows loaded to the dictionary it gets
+@contextlib.contextmanager
+def timed_stage(stage, **tags):
+    stage_fields = dict(tags)
+    stage_start = time.perf_counter()
+
+    try:
+        yield stage_fields
+    except Exception as ex:
+        emit_metric('stage', stage=stage, status='failed', secs=round(time.perf_counter() - stage_start, 3),
+                    error=repr(ex), **stage_fields)
+        raise
+
+    emit_metric('stage', stage=stage, status='ok', secs=round(time.perf_counter() - stage_start, 3),
+                **stage_fields)
+
+
+# Split a CSV codec into its name and level, e.g. 'gzip-1' into ('gzip', 1). The level is None if not given
+def split_codec(codec):
+    codec_nm, _, level = codec.partition('-')
+
+    if codec_nm not in CSV_CODECS:
+        raise ValueError(f"Unknown CSV codec '{codec}'. Use one of {sorted(CSV_CODECS)}, with an optional level")
+
+    return codec_nm, int(level) if level else None
+
+
+# Compress a staged CSV file. gzip and bzip2 default to level 9, zstd to 3 and lzop to 3
+def compress_bytes(data, codec):
+    codec_nm, level = split_codec(codec)
+
+    if codec_nm == 'gzip':
+        # mtime 0 so the same chunk always compresses to the same bytes
+        return gzip.compress(data, compresslevel=9 if level is None else level, mtime=0)
+    if codec_nm == 'bzip2':
+        return bz2.compress(data, 9 if level is None else level)
+    if codec_nm == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+    if codec_nm == 'lzop':
+        if shutil.which('lzop') is None:
+            raise RuntimeError('lzop codec requires the lzop command line tool')
+        return subprocess.run(['lzop', '-c', f'-{3 if level is None else level}'], input=data,
+                              stdout=subprocess.PIPE, check=True).stdout
+
+    return data
+
+
+# Decompress a staged CSV file, e.g. to check or load it somewhere other than Redshift
+def decompress_bytes(data, codec):
+    codec_nm, _ = split_codec(codec)
+
+    if codec_nm == 'gzip':
+        return gzip.decompress(data)
+    if codec_nm == 'bzip2':
+        return bz2.decompress(data)
+    if codec_nm == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    if codec_nm == 'lzop':
+        if shutil.which('lzop') is None:
+            raise RuntimeError('lzop codec requires the lzop command line tool')
+        return subprocess.run(['lzop', '-dc'], input=data, stdout=subprocess.PIPE, check=True).stdout
+
+    return data
+
+
+# Check if the packages a CSV codec needs are installed, e.g. before the auto mode tries it
+def codec_available(codec):
+    codec_nm, _ = split_codec(codec)
+
+    if codec_nm == 'zstd':
+        return importlib.util.find_spec('zstandard') is not None
+    if codec_nm == 'lzop':
+        return shutil.which('lzop') is not None
+
+    return True
+
+
+# Write one CSV chunk with pandas and compress it to an in-memory buffer. Avoids the round trip through a local
+# folder, so the size of the dataframe is not capped by local disk space
+def write_df_to_csv(chunk_dfm, codec='gzip'):
+    raw_buf = io.BytesIO()
+    chunk_dfm.to_csv(raw_buf, index=False, quoting=csv.QUOTE_NONNUMERIC)
+
+    return io.BytesIO(compress_bytes(raw_buf.getvalue(), codec))
+
+
+# Write one CSV chunk with the pyarrow CSV writer and compress it to an in-memory buffer. The writer formats
+# the columns in C++ over several threads, so it is much faster than pandas to_csv. Only values that need it
+# are quoted, and NULLs are written unquoted so COPY reads them as NULL. Timestamps are written in microseconds
+# as Redshift has no nanosecond timestamps
+def write_df_to_arrow_csv(chunk_dfm, codec='gzip'):
+    tbl = pa.Table.from_pandas(chunk_dfm, preserve_index=False)
+
+    for col_num, fld in enumerate(tbl.schema):
+        if pa.types.is_timestamp(fld.type) and fld.type.unit == 'ns':
+            tbl = tbl.set_column(col_num, fld.name,
+                                 tbl.column(col_num).cast(pa.timestamp('us', fld.type.tz), safe=False))
+
+    raw_buf = io.BytesIO()
+    pa_csv.write_csv(tbl, raw_buf, pa_csv.WriteOptions(quoting_style='needed'))
+
+    return io.BytesIO(compress_bytes(raw_buf.getvalue(), codec))
+
+
+# Write one chunk as a Parquet file to an in-memory buffer. Keeps the dtypes and avoids CSV text formatting and
+# quoting, so the files are smaller, quicker to write and there is no NULL ambiguity for COPY. Timestamps are
+# written in microseconds as COPY does not read nanosecond Parquet timestamps
+def write_df_to_parquet(chunk_dfm, codec='snappy'):
+    buf = io.BytesIO()
+    chunk_dfm.to_parquet(buf, engine='pyarrow', compression=codec, index=False,
+                         coerce_timestamps='us', allow_truncated_timestamps=True)
+    buf.seek(0)
+
+    return buf
+
+
+# Encoder of each staging format. Each takes a chunk and a codec and returns the staged file in a buffer
+STAGE_ENCODERS = {'csv': write_df_to_csv, 'arrow_csv': write_df_to_arrow_csv, 'parquet': write_df_to_parquet}
+
+
+# Get the columns whose dtype can't be staged through Arrow and loaded by COPY. Timedelta, complex, period and
+# interval columns have no Parquet type the warehouses read, uint64 overflows a 64 bit integer and object columns
+# holding mixed types can't be written by Arrow at all
+def parquet_unsupported_cols(dfm):
+    bad_cols = []
+
+    for col in dfm.columns:
+        dtyp = dfm[col].dtype
+
+        if (pd.api.types.is_timedelta64_dtype(dtyp) or pd.api.types.is_complex_dtype(dtyp)
+                or isinstance(dtyp, (pd.PeriodDtype, pd.IntervalDtype))):
+            bad_cols.append(col)
+        elif pd.api.types.is_unsigned_integer_dtype(dtyp) and dtyp.itemsize == 8:
+            bad_cols.append(col)
+        elif dtyp == object and pd.api.types.infer_dtype(dfm[col], skipna=True) not in PARQUET_OBJECT_TYPES:
+            bad_cols.append(col)
+
+    return bad_cols
+
+
+# Use Parquet or the pyarrow CSV writer only if every column can go through Arrow, otherwise fall back to CSV
+# written by pandas. The codec of the format is used if none is given, and on a fallback.
+# Returns the staging format and codec
+def resolve_stage_format(dfm, stage_fmt, codec=None):
+    if stage_fmt not in STAGE_ENCODERS:
+        raise ValueError(f"Unknown stage_fmt '{stage_fmt}'. Use one of {sorted(STAGE_ENCODERS)} or 'auto'")
+
+    if stage_fmt != 'csv':
+        bad_cols = parquet_unsupported_cols(dfm)
+        if bad_cols:
+            print(f'Columns {bad_cols} can\'t be staged as {stage_fmt}. Falling back to CSV staging')
+            return 'csv', DEFAULT_CODECS['csv']
+
+    codec = codec or DEFAULT_CODECS[stage_fmt]
+    if stage_fmt == 'parquet':
+        if codec not in PARQUET_CODECS:
+            raise ValueError(f"Unknown Parquet codec '{codec}'. Use one of {list(PARQUET_CODECS)}")
+    else:
+        split_codec(codec)
+
+    return stage_fmt, codec
+
+
+# Encode one chunk in the staging format
+def encode_chunk(chunk_dfm, stage_fmt, codec):
+    return STAGE_ENCODERS[stage_fmt](chunk_dfm, codec)
+
+
+# Get the extension of the staged files
+def stage_file_ext(stage_fmt, codec):
+    if stage_fmt == 'parquet':
+        return '.parquet'
+
+    return CSV_CODECS[split_codec(codec)[0]]
+
+
+# Set the source the pool workers read their chunks from. Must be set before a fork pool is created so the
+# workers inherit it, and cleared once the pool is done
+def set_chunk_source(chunk_src):
+    global _chunk_src
+
+    _chunk_src = chunk_src
+
+
+# Write the dataframe to an Arrow IPC stream in record batches of about SHM_BATCH_BYTES, converted one at a time,
+# so no more than one batch of Arrow copy is held at once. Every batch has the schema of the whole dataframe. The
+# size of a row is measured on the first rows, with the strings of object columns
+def write_ipc_stream(sink, dfm, schema):
+    head_dfm = dfm.head(SAMPLE_ROWS)
+    row_bytes = head_dfm.memory_usage(index=False, deep=True).sum() / max(len(head_dfm), 1)
+    batch_rows = max(1, int(SHM_BATCH_BYTES // row_bytes)) if row_bytes else max(1, len(dfm))
+
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for batch_start in range(0, len(dfm), batch_rows):
+            writer.write_batch(pa.RecordBatch.from_pandas(dfm.iloc[batch_start:batch_start + batch_rows],
+                                                          schema=schema, preserve_index=False))
+
+
+# Put the dataframe in shared memory as an Arrow IPC stream. Workers map the Arrow buffers in place instead
+# of each receiving a pickled copy of their chunk. Works with any multiprocessing start method.
+# The stream is written twice, a record batch at a time: once to measure its size so the shared memory block can
+# be allocated up front, and once to fill the block. The parent never holds a full Arrow copy next to the
+# dataframe and the block, so its peak memory is about twice the size of the dataframe
+def df_to_shared_memory(dfm):
+    schema = pa.Schema.from_pandas(dfm, preserve_index=False)
+
+    mock_sink = pa.MockOutputStream()
+    write_ipc_stream(mock_sink, dfm, schema)
+
+    shm = shared_memory.SharedMemory(create=True, size=max(mock_sink.size(), 1))
+    write_ipc_stream(pa.FixedSizeBufferWriter(pa.py_buffer(shm.buf)), dfm, schema)
+
+    return shm
+
+
+# Pool initializer for the shared memory mode. Attach to the block and read the Arrow table without copying it.
+# A batch passes a dictionary of block names by job, and gets a dictionary of tables
+def init_chunk_source(shm_name):
+    global _chunk_src, _chunk_shm
+
+    if isinstance(shm_name, dict):
+        _chunk_shm = {src_key: shared_memory.SharedMemory(name=nm) for src_key, nm in shm_name.items()}
+        _chunk_src = {src_key: pa.ipc.open_stream(pa.py_buffer(shm.buf)).read_all()
+                      for src_key, shm in _chunk_shm.items()}
+    else:
+        _chunk_shm = shared_memory.SharedMemory(name=shm_name)
+        _chunk_src = pa.ipc.open_stream(pa.py_buffer(_chunk_shm.buf)).read_all()
+
+
+# Get the rows of one chunk from the source the worker has access to. Only the chunk itself is materialized.
+# src_key picks the source of the job in a batch
+def get_chunk(chunk_start, chunk_end, src_key=None):
+    chunk_src = _chunk_src if src_key is None else _chunk_src[src_key]
+
+    if isinstance(chunk_src, pa.Table):
+        return chunk_src.slice(chunk_start, chunk_end - chunk_start).to_pandas()
+
+    return chunk_src.iloc[chunk_start:chunk_end]
+
+
+# Estimate the compressed size of a row by encoding a random sample of the dataframe the same way the chunks
+# will be encoded. The in-memory size from memory_usage() says little about the size of the files on S3
+def estimate_bytes_per_row(dfm, stage_fmt, codec, sample_rows=SAMPLE_ROWS):
+    if len(dfm) == 0:
+        return 0
+
+    smpl = dfm.sample(n=min(sample_rows, len(dfm)), random_state=0)
+    buf = encode_chunk(smpl, stage_fmt, codec)
+
+    return buf.getbuffer().nbytes / len(smpl)
+
+
+# Pick the staging format and codec that will get the data to the stage fastest. Each candidate encodes a sample
+# of the rows, giving its CPU time and compressed size per row. Encoding runs on pl_siz workers and overlaps with
+# uploading, so the estimated time of a candidate is the longer of the two. A slow link favours the smallest
+# files, a fast one the cheapest encoding. candidates can leave out codecs the warehouse can't load
+def choose_stage_encoding(dfm, pl_siz, link_mb_per_sec, sample_rows=SAMPLE_ROWS, candidates=AUTO_CANDIDATES):
+    smpl = dfm.sample(n=min(sample_rows, len(dfm)), random_state=0)
+    arrow_ok = not parquet_unsupported_cols(dfm)
+
+    best = None
+    for stage_fmt, codec in candidates:
+        if (stage_fmt != 'csv' and not arrow_ok) or (stage_fmt != 'parquet' and not codec_available(codec)):
+            continue
+
+        # Best of two, so that one-off costs such as imports are not counted
+        encode_secs = []
+        for _ in range(2):
+            encode_start = time.perf_counter()
+            nbytes = encode_chunk(smpl, stage_fmt, codec).getbuffer().nbytes
+            encode_secs.append(time.perf_counter() - encode_start)
+
+        cpu_secs = min(encode_secs) / pl_siz
+        upload_secs = nbytes / (link_mb_per_sec * 1024 * 1024)
+        est_secs = max(cpu_secs, upload_secs)
+        emit_metric('encoding_trial', stage_fmt=stage_fmt, codec=codec, sample_rows=len(smpl), bytes=nbytes,
+                    encode_secs=round(min(encode_secs), 4), est_secs=round(est_secs, 4),
+                    link_mb_per_sec=round(link_mb_per_sec, 1))
+
+        if best is None or (est_secs, nbytes) < best[0]:
+            best = ((est_secs, nbytes), stage_fmt, codec)
+
+    print(f'Staging as {best[1]} with codec {best[2]} for a link of {link_mb_per_sec:.1f} MB/s')
+
+    return best[1], best[2]
+
+
+# Plan the row ranges of the chunks. The number of chunks is a multiple of the slice count (the number of files
+# the warehouse loads at once), with as few files per slice as keeps each file under max_file_bytes. If there
+# isn't enough data for every slice to get a file of at least min_file_bytes, fewer and bigger files are used
+# instead. The ranges cover every row
+def plan_chunks(total_rows, bytes_per_row, num_slices, min_file_bytes, max_file_bytes):
+    if total_rows == 0:
+        return []
+
+    num_slices = max(1, num_slices)
+    est_bytes = total_rows * bytes_per_row
+
+    files_per_slice = max(1, math.ceil(est_bytes / (num_slices * max_file_bytes)))
+    num_chunks = num_slices * files_per_slice
+
+    if est_bytes / num_chunks < min_file_bytes:
+        num_chunks = max(1, min(num_slices, int(est_bytes // min_file_bytes)))
+
+    num_chunks = min(num_chunks, total_rows)
+    bounds = [total_rows * i // num_chunks for i in range(num_chunks + 1)]
+
+    return list(zip(bounds[:-1], bounds[1:]))
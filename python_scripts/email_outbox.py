@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+"""email_outbox.py: Send alert emails from a background thread over one reused SMTP session."""
+
+"""
+Opening an SMTP connection for every email costs a TCP connect, a TLS handshake and a login, and a job that sends
+an alert waits for all of it and for the mail server. EmailOutbox queues the emails instead and sends them from a
+background thread:
+- One authenticated SMTP session is kept open and reused for every email. It is closed after idle_secs without
+  emails. A NOOP at the start of each batch finds a session the server has dropped, which is then opened again
+- Emails queued while one is being sent go out as a batch on the same session
+- An email that fails to send is retried with exponential backoff, on a new session, before it is given up on
+- The delay from queueing to sending of each email is kept, and stats() gives its p50 and p95
+
+The sender thread only runs in the process that created the outbox. An email sent from a child process, e.g. by a
+job run in process mode, is sent directly on its own connection.
+
+It can be tried against a local SMTP server such as aiosmtpd (python -m aiosmtpd -n -l localhost:8025) with
+use_tls False and no password.
+
+Used by python_scheduling.py.
+"""
+
+import collections
+import os
+import queue
+import smtplib
+import ssl
+import threading
+import time
+
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+
+__author__ = "Arindam Sinha"
+__license__ = "GPL"
+__version__ = "1.0.0"
+__status__ = "Prototype"
+
+# Latencies kept for the stats
+LATENCY_WINDOW = 1000
+
+
+# Build an HTML email. eml_rcvrs is a comma separated list of addresses
+def build_message(eml_sndr, eml_rcvrs, subject, message_body):
+    message = MIMEMultipart("alternative")
+    message["Subject"] = subject
+    message["From"] = eml_sndr
+    message["To"] = eml_rcvrs
+
+    body = MIMEText(message_body, "html")
+    message.attach(body)
+
+    return message
+
+
+# Open an SMTP session, with STARTTLS and login if asked for
+def open_smtp(smtp_server, port, eml_sndr, password, use_tls=True, timeout=30):
+    server = smtplib.SMTP(smtp_server, port, timeout=timeout)
+    server.ehlo()
+    if use_tls:
+        server.starttls(context=ssl.create_default_context())
+        server.ehlo()
+    if password:
+        server.login(eml_sndr, password)
+
+    return server
+
+
+# Get a percentile of a list of values
+def percentile(vals, pct):
+    if not vals:
+        return None
+
+    vals = sorted(vals)
+
+    return vals[min(int(len(vals) * pct / 100), len(vals) - 1)]
+
+
+# Queue of emails sent by a background thread over one reused SMTP session
+class EmailOutbox:
+    def __init__(self, smtp_server, port, eml_sndr, password, use_tls=True, batch_size=20, max_retries=3,
+                 idle_secs=60):
+        self.smtp_server = smtp_server
+        self.port = port
+        self.eml_sndr = eml_sndr
+        self.password = password
+        self.use_tls = use_tls
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.idle_secs = idle_secs
+
+        self.outbox = queue.Queue()
+        self.server = None
+        self.owner_pid = os.getpid()
+        self.counts = collections.Counter()
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.stats_lock = threading.Lock()
+
+        self.thread = threading.Thread(target=self.run, name='email-outbox', daemon=True)
+        self.thread.start()
+
+    # Queue an HTML email. Returns at once, the email is sent by the sender thread
+    def send(self, eml_rcvrs, subject, message_body):
+        message = build_message(self.eml_sndr, eml_rcvrs, subject, message_body)
+
+        # A forked child has a copy of the outbox but not its sender thread, so send directly
+        if os.getpid() != self.owner_pid:
+            server = open_smtp(self.smtp_server, self.port, self.eml_sndr, self.password, self.use_tls)
+            try:
+                server.send_message(message)
+            finally:
+                server.quit()
+            return
+
+        self.outbox.put((time.monotonic(), message))
+
+    # Close the session if the server has dropped it
+    def check_server(self):
+        if self.server is not None:
+            try:
+                self.server.noop()
+            except (smtplib.SMTPException, OSError):
+                self.close_server()
+
+    # Get the open session, or open one if there is none
+    def get_server(self):
+        if self.server is not None:
+            return self.server
+
+        self.server = open_smtp(self.smtp_server, self.port, self.eml_sndr, self.password, self.use_tls)
+        with self.stats_lock:
+            self.counts['connects'] += 1
+
+        return self.server
+
+    def close_server(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                self.server.close()
+            self.server = None
+
+    # Send one email, retrying with backoff on a new session. Returns True if it was sent
+    def send_with_retry(self, message):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.get_server().send_message(message)
+                return True
+            except (smtplib.SMTPException, OSError) as ex:
+                self.close_server()
+                if attempt == self.max_retries:
+                    print(f"Failed to send email '{message['Subject']}' to {message['To']}: {ex}")
+                    return False
+
+                with self.stats_lock:
+                    self.counts['retries'] += 1
+                time.sleep(2 ** attempt)
+
+    # Sender thread. Takes the next email and any others queued behind it, up to batch_size, and sends them on the
+    # same session. Closes the session when idle. A None in the queue stops it
+    def run(self):
+        while True:
+            try:
+                batch = [self.outbox.get(timeout=self.idle_secs)]
+            except queue.Empty:
+                self.close_server()
+                continue
+
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self.outbox.get_nowait())
+                except queue.Empty:
+                    break
+
+            self.check_server()
+            for item in batch:
+                if item is None:
+                    self.close_server()
+                    return
+
+                queued_at, message = item
+                sent = self.send_with_retry(message)
+                with self.stats_lock:
+                    self.counts['sent' if sent else 'failed'] += 1
+                    if sent:
+                        self.latencies.append(time.monotonic() - queued_at)
+
+            with self.stats_lock:
+                self.counts['batches'] += 1
+
+    # Emails sent and failed, retries, sessions opened and batches, with the p50 and p95 seconds from queueing to
+    # sending of the last LATENCY_WINDOW emails sent
+    def stats(self):
+        with self.stats_lock:
+            latencies = list(self.latencies)
+            outbox_stats = dict(self.counts)
+
+        outbox_stats.update({'queued': self.outbox.qsize(), 'latency_p50_secs': percentile(latencies, 50),
+                             'latency_p95_secs': percentile(latencies, 95)})
+
+        return outbox_stats
+
+    # Send the emails still queued and close the session. Waits up to timeout seconds
+    def close(self, timeout=60):
+        self.outbox.put(None)
+        self.thread.join(timeout)
@@ -5,10 +5,39 @@
 """
 Saving a dataframe to a Redshift table using Pandas df.to_sql is extremely slow.
 This script provides a much faster method by using the following optimizations:
-1) Break the dataframe into chunks and save them as separate csv files in parallel
-2) Load the files to S3 in parallel
-3) Load the files on S3 to the Redshift table in parallel using COPY command with file prefix
+1) Break the dataframe into chunks and save them as separate csv files in parallel, in memory
+2) Upload each file to S3 as soon as it is written, so compression and upload overlap
+3) Load the files on S3 to the Redshift table in parallel using COPY command with a manifest of the files
 4) The CSV files are gzipped to make above three steps even faster
+5) Only row offsets are sent to the worker processes. They read their chunk from the dataframe inherited on
+   fork, or from Arrow buffers in shared memory, so the dataframe is not copied into every worker
+6) Optionally the chunks can be staged as Parquet (snappy or zstd) instead of gzipped CSV and loaded with
+   COPY ... FORMAT AS PARQUET. Falls back to CSV if any column has a dtype that Parquet COPY can't load
+7) The number of chunks is a multiple of the cluster's slice count and each file is sized to fall in Redshift's
+   recommended 1-125 MB compressed, using the measured compressed size of a sample of the rows
+8) Sources too big for memory can be streamed. The CSV or Parquet file is read in batches and each batch is
+   staged and uploaded as it is read, so memory use stays flat however big the file is
+9) Failed uploads are retried per chunk, and a local checkpoint records which chunks were uploaded and whether
+   the COPY completed. A failed run resumes by sending only the missing chunks
+10) Each worker reuses one S3 client with a sized connection pool, and large chunks are uploaded as parallel
+    multipart parts
+11) Secrets are fetched from Secrets Manager once and cached (secrets_cache.py), and the Redshift connection is
+    pooled and reused by every stage of the load
+12) The table is created with one DDL statement generated from the dtypes, with VARCHARs sized from the longest
+    value and optional DISTKEY, SORTKEY and column ENCODE settings, instead of a one row to_sql followed by a DELETE
+13) Besides replacing the table, data can be merged into it on key columns. The files are loaded in parallel into
+    a temporary staging table and applied with MERGE (or DELETE and INSERT) in the same transaction
+14) Each stage and each chunk emits metrics as JSON lines, or to a StatsD or Prometheus style hook: serialize time,
+    compressed bytes, compression ratio, upload throughput, COPY time and rows loaded. These show whether a slow
+    load is bound by CPU, network or the cluster
+15) CSV can be written by the much faster pyarrow CSV writer, and compressed with gzip at any level, zstd, bzip2
+    or lzop. An auto mode encodes a sample with each and picks the fastest for the measured speed of the link
+16) Many dataframes or files can be loaded into their tables as one batch (load_tables_parallel). All their
+    chunks share one pool, and each table is loaded as soon as its files are up, with several COPYs at once
+17) Each run stages its files under its own run ID prefix and COPYs only its own files, so many loads can share
+    one staging bucket. The files are deleted after the COPY in the background, in batches of 1000 keys
+18) The chunk planning, encoders and metrics are in df_staging.py, shared with the Snowflake loader
+    fast_save_df_to_snowflake.py
 
 With the sample dataset trade_transactions.csv in https://github.com/arindamsinha12/scripts/tree/main/data, the
 df.to_sql takes over 21 minutes to load the data to Redshift. With the above optimizations,
@@ -18,10 +47,20 @@ that loading time reduces to 45 seconds! For larger datasets, the gains will be
 # Requires installation of sqlalchemy-redshift and redshift_connector
 # pip install sqlalchemy-redshift
 # pip install redshift_connector
+# pip install pyarrow
+# Staging CSV files with zstd also requires zstandard, and with lzop the lzop command line tool (see df_staging.py)
+# pip install zstandard
 
 import multiprocessing
+import collections
+import contextlib
+import hashlib
+import io
 import os
-import shutil
+import queue
+import threading
+import time
+import traceback
 import pandas as pd
 import boto3
 import json
@@ -29,38 +68,78 @@ import csv
 import numpy as np
 import redshift_connector
 import sqlalchemy as sa
+import pyarrow.parquet as pq
 
+from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy.engine.url import URL
-from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from datetime import datetime
+from secrets_cache import get_secret
+from df_staging import (SAMPLE_ROWS, configure_metrics, emit_metric, timed_stage, split_codec,
+                        resolve_stage_format, encode_chunk, stage_file_ext, df_to_shared_memory, init_chunk_source,
+                        set_chunk_source, get_chunk, estimate_bytes_per_row, choose_stage_encoding, plan_chunks,
+                        UPLOAD_RETRIES, new_run_id, quote_ident)
 
 __author__ = "Arindam Sinha"
 __license__ = "GPL"
 __version__ = "1.0.0"
 __status__ = "Prototype"
 
+# S3 client of this process, created on first use and reused for every chunk. Set with configure_s3 before the
+# pool is created so the workers get the same settings. endpoint_url can point to MinIO or a moto server
+_s3_client = None
+_s3_client_pid = None
+_s3_cfg = {
+    'endpoint_url': None,
+    'max_pool_conns': 20,  # Should be at least max_concurrency
+    'multipart_threshold': 16 * 1024 * 1024,  # Chunks bigger than this are uploaded as parallel parts
+    'multipart_chunksize': 16 * 1024 * 1024,
+    'max_concurrency': 10  # Parts of one chunk uploaded at a time
+}
+
+# Open Redshift connections of this process, reused by every stage of a load
+_conn_pool = []
+_conn_lock = threading.Lock()
+_conn_pid = None
+# Connections kept open between stages
+MAX_IDLE_CONNS = 4
+
+# Redshift recommends compressed load files of 1-125 MB, with the number of files a multiple of the slice count
+MIN_FILE_BYTES = 1 * 1024 * 1024
+MAX_FILE_BYTES = 125 * 1024 * 1024
+# Slice count used when the cluster reports none, e.g. when the user can't see stv_slices (a 2 node dc2.large)
+DEFAULT_SLICE_COUNT = 4
+
+# Longest VARCHAR Redshift allows, in bytes
+MAX_VARCHAR_BYTES = 65535
+
+# Redshift column types for object columns by pd.api.types.infer_dtype. Others are VARCHAR
+OBJECT_COL_TYPES = {'boolean': 'BOOLEAN', 'integer': 'BIGINT', 'floating': 'DOUBLE PRECISION', 'date': 'DATE',
+                    'datetime': 'TIMESTAMP', 'decimal': 'DECIMAL(38, 10)'}
+
+# Load modes of a table, and the methods a merge can be applied with
+LOAD_MODES = ('replace', 'merge')
+MERGE_METHODS = ('merge', 'delete_insert')
+
+# COPY option for each codec CSV files can be compressed with
+COPY_CSV_COMPRESSION = {'gzip': 'GZIP', 'bzip2': 'BZIP2', 'zstd': 'ZSTD', 'lzop': 'LZOP', 'none': ''}
+# Bytes uploaded by each worker to measure the speed of the link to S3
+LINK_TEST_BYTES = 8 * 1024 * 1024
+# Most keys one delete_objects call can take
+DELETE_PAGE_KEYS = 1000
+
+# Threads deleting the staged files of finished loads, waited for with wait_for_cleanups
+_cleanup_threads = []
+
+
 # Get the IAM Role from AWS Secrets Manager to authorize the COPY command
 def get_secret_iam_role():
     secret_name = "<<IAM Role Secret Name>>"
     region_name = "us-west-2"
 
-
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
-
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name
-        )
-    except ClientError as e:
-        raise e
-
-    # Decrypts secret using the associated KMS key.
-    secret = json.loads(get_secret_value_response['SecretString'])
+    # Served from the cache after the first call
+    secret = get_secret(secret_name, region_name)
 
     # Your code goes here.
     iam_role_copy = secret['iam_role_copy_command_access']
@@ -73,23 +152,8 @@ def get_secret_creds():
     secret_name = "<<Redshift Credentials Secret Name>>"
     region_name = "us-west-2"
 
-
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
-
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name
-        )
-    except ClientError as e:
-        raise e
-
-    # Decrypts secret using the associated KMS key.
-    secret = json.loads(get_secret_value_response['SecretString'])
+    # Served from the cache after the first call
+    secret = get_secret(secret_name, region_name)
 
     # Get the credentials
     hst = secret['host']
@@ -132,153 +196,1089 @@ def create_redshift_conn():
     return conn
 
 
-# Write one CSV chunk to local folder compressed with gzip
-def write_df_to_csv(params):
-    locl_fldr, file_nm, chunk_dfm = params
+# Get a Redshift connection for one stage of a load, from the pool of open connections if there is one.
+# Every stage reuses the same few connections instead of paying for a new login and TLS handshake each time.
+# The connection goes back to the pool when the stage succeeds. On an error it is rolled back and closed,
+# as it may be broken. Connections are never shared across processes
+@contextlib.contextmanager
+def redshift_conn():
+    global _conn_pid
+
+    with _conn_lock:
+        if _conn_pid != os.getpid():
+            _conn_pool.clear()
+            _conn_pid = os.getpid()
+
+        conn = _conn_pool.pop() if _conn_pool else None
+
+    if conn is None:
+        conn = create_redshift_conn()
+
+    try:
+        yield conn
+    except Exception:
+        try:
+            conn.rollback()
+            conn.close()
+        except Exception:
+            pass
+        raise
+
+    with _conn_lock:
+        if len(_conn_pool) < MAX_IDLE_CONNS:
+            _conn_pool.append(conn)
+            conn = None
+
+    if conn is not None:
+        conn.close()
+
+
+# Close the pooled connections at the end of a run
+def close_redshift_conns():
+    with _conn_lock:
+        while _conn_pool:
+            _conn_pool.pop().close()
+
+
+# Change the S3 client and multipart transfer settings. The cached client is recreated with the new settings
+def configure_s3(**s3_cfg):
+    global _s3_client
+
+    unknown = set(s3_cfg) - set(_s3_cfg)
+    if unknown:
+        raise ValueError(f'Unknown S3 settings {sorted(unknown)}')
+
+    _s3_cfg.update(s3_cfg)
+    _s3_client = None
+
+
+# Get the S3 client of this process. Credential resolution and connection setup are only paid once per process
+# instead of once per chunk. A client isn't safe to share across a fork, so each process creates its own
+def get_s3_client():
+    global _s3_client, _s3_client_pid
+
+    if _s3_client is None or _s3_client_pid != os.getpid():
+        _s3_client = boto3.session.Session().client(
+            's3',
+            endpoint_url=_s3_cfg['endpoint_url'],
+            config=Config(max_pool_connections=_s3_cfg['max_pool_conns'])
+        )
+        _s3_client_pid = os.getpid()
+
+    return _s3_client
+
+
+# Upload a staged chunk to S3. Chunks over the multipart threshold are uploaded as parts in parallel.
+# Returns the time taken, reported with the throughput in the chunk metrics
+def upload_to_s3(fobj, s3_bkt, file_name):
+    transfer_cfg = TransferConfig(multipart_threshold=_s3_cfg['multipart_threshold'],
+                                  multipart_chunksize=_s3_cfg['multipart_chunksize'],
+                                  max_concurrency=_s3_cfg['max_concurrency'])
+
+    upload_start = time.perf_counter()
+    get_s3_client().upload_fileobj(fobj, s3_bkt, file_name, Config=transfer_cfg)
+    upload_secs = max(time.perf_counter() - upload_start, 1e-6)
+
+    return upload_secs
+
+
+# Pool initializer. Apply the S3 settings of the parent, and attach to the shared memory block if there is one
+def init_worker(s3_cfg, shm_name=None):
+    configure_s3(**s3_cfg)
+
+    if shm_name is not None:
+        init_chunk_source(shm_name)
+
+
+# Get the number of slices in the cluster. Each slice loads one file at a time during COPY. stv_slices only shows
+# a user the slices it has access to, so when it shows none the default is used instead
+def get_slice_count(default=DEFAULT_SLICE_COUNT):
+    with redshift_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM stv_slices")
+        num_slices = cur.fetchone()[0]
+
+    if not num_slices:
+        print(f'No slices visible in stv_slices, using the default slice count of {default}')
+        return default
+
+    return num_slices
+
+
+# Measure the speed of the link to S3 in MB/s by uploading incompressible data from pl_siz threads at once,
+# as the workers will. The test objects are deleted again
+def measure_link_speed(s3_bkt, pl_siz):
+    test_data = os.urandom(LINK_TEST_BYTES)
+    test_keys = [f'_link_test_{os.getpid()}_{i}' for i in range(pl_siz)]
+
+    link_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=pl_siz) as executor:
+        list(executor.map(lambda key: upload_to_s3(io.BytesIO(test_data), s3_bkt, key), test_keys))
+    link_secs = time.perf_counter() - link_start
+
+    get_s3_client().delete_objects(Bucket=s3_bkt, Delete={'Objects': [{'Key': key} for key in test_keys]})
+
+    return LINK_TEST_BYTES * pl_siz / (1024 * 1024) / link_secs
+
+
+# Get the key of a staged file of a run, e.g. trade_trans/20240101T120000-1a2b3c4d/trade_trans_0.gz
+def stage_key(out_fil_pref, run_id, chunk_num, file_ext):
+    return f'{out_fil_pref}/{run_id}/{out_fil_pref.rsplit("/", 1)[-1]}_{chunk_num}{file_ext}'
+
+
+# Get the prefix the files of a run were staged under, from the keys of its files
+def run_prefix_of(upload_list):
+    return upload_list[0][0].rsplit('/', 1)[0] + '/'
+
+
+# Delete every file staged under the prefix of a run, a page of up to 1000 keys per call. Only the run's own
+# prefix is listed, so the cost doesn't grow with the size of the bucket. Returns the number of files deleted
+def delete_run_files(s3_bkt, run_prefix):
+    s3_client = get_s3_client()
+    num_deleted = 0
+
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=s3_bkt, Prefix=run_prefix, PaginationConfig={'PageSize': DELETE_PAGE_KEYS}):
+        keys = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+        if keys:
+            s3_client.delete_objects(Bucket=s3_bkt, Delete={'Objects': keys, 'Quiet': True})
+            num_deleted += len(keys)
+
+    return num_deleted
+
+
+# Delete the staged files of a run in a background thread once its COPY has been committed, so the next stage
+# or the next load doesn't wait for it. Files of runs that never finish are kept for the rerun. A lifecycle rule
+# on the staging bucket expiring objects after a few days takes care of the ones that are never rerun
+def cleanup_run_async(s3_bkt, run_prefix):
+    def cleanup():
+        with timed_stage('cleanup', prefix=run_prefix) as cleanup_fields:
+            cleanup_fields['files'] = delete_run_files(s3_bkt, run_prefix)
+
+    cleanup_thrd = threading.Thread(target=cleanup)
+    cleanup_thrd.start()
+    _cleanup_threads.append(cleanup_thrd)
+
+    return cleanup_thrd
+
+
+# Wait for the background deletes of staged files to finish, e.g. before the process exits
+def wait_for_cleanups():
+    while _cleanup_threads:
+        _cleanup_threads.pop().join()
+
+
+# Fingerprint of the data in a dataframe. A checkpoint is only resumed for the same data
+def df_fingerprint(dfm):
+    row_hashes = pd.util.hash_pandas_object(dfm, index=False).values
+
+    return hashlib.sha1(str(list(dfm.columns)).encode() + row_hashes.tobytes()).hexdigest()
+
+
+# Fingerprint of a source file, from its path, size and modification time
+def file_fingerprint(file_path):
+    stat = os.stat(file_path)
+
+    return f'{os.path.abspath(file_path)}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+# Read the checkpoint of a previous run. Start a new one with a new run ID if there is none, or if it was for a
+# different plan (other data, chunking or staging format), as its uploaded files can't be reused. A resumed run
+# keeps its run ID, so it finds the files it already staged
+def load_checkpoint(ckpt_path, plan):
+    if ckpt_path and os.path.exists(ckpt_path):
+        with open(ckpt_path, 'r') as ckpt_file:
+            ckpt = json.load(ckpt_file)
+
+        if ckpt['plan'] == plan and 'run_id' in ckpt:
+            return ckpt
+
+    return {'plan': plan, 'run_id': new_run_id(), 'chunks': {}, 'loaded': False}
+
+
+# Save the checkpoint. Written to a temporary file and renamed so a crash never leaves a partial checkpoint
+def save_checkpoint(ckpt_path, ckpt):
+    if not ckpt_path:
+        return
+
+    tmp_path = ckpt_path + '.tmp'
+    with open(tmp_path, 'w') as ckpt_file:
+        json.dump(ckpt, ckpt_file)
+
+    os.replace(tmp_path, ckpt_path)
+
+
+# Check whether the data with this fingerprint has already been loaded by the run that left the checkpoint
+def checkpoint_loaded(ckpt_path, fingerprint):
+    if not ckpt_path or not os.path.exists(ckpt_path):
+        return False
+
+    with open(ckpt_path, 'r') as ckpt_file:
+        ckpt = json.load(ckpt_file)
+
+    return ckpt['loaded'] and ckpt['plan']['fingerprint'] == fingerprint
+
+
+# Upload a staged chunk and check the size of the object that landed on S3, retrying with backoff. A failed or
+# truncated upload is retried here rather than being found out by COPY.
+# Returns the size, the time of the upload that succeeded and the number of attempts
+def upload_with_retry(buf, s3_bkt, file_nm):
+    # The upload closes the buffer, so each attempt reads from a new buffer over the same bytes
+    data = buf.getvalue()
+    nbytes = len(data)
+
+    for attempt in range(UPLOAD_RETRIES + 1):
+        try:
+            upload_secs = upload_to_s3(io.BytesIO(data), s3_bkt, file_nm)
+
+            s3_bytes = get_s3_client().head_object(Bucket=s3_bkt, Key=file_nm)['ContentLength']
+            if s3_bytes != nbytes:
+                raise IOError(f'{s3_bytes} bytes on S3 for {file_nm}, {nbytes} bytes were uploaded')
+
+            return nbytes, upload_secs, attempt + 1
+        except Exception:
+            if attempt == UPLOAD_RETRIES:
+                raise
+
+            time.sleep(2 ** attempt)
+
+
+# Encode a chunk and upload it, measuring each step. Returns the staged size and the metrics of the chunk.
+# frame_bytes is the in-memory size of the chunk, the compression ratio is relative to it
+def encode_and_upload(chunk_dfm, s3_bkt, file_nm, stage_fmt, codec):
+    encode_start = time.perf_counter()
+    buf = encode_chunk(chunk_dfm, stage_fmt, codec)
+    serialize_secs = time.perf_counter() - encode_start
+
+    nbytes, upload_secs, attempts = upload_with_retry(buf, s3_bkt, file_nm)
+    frame_bytes = int(chunk_dfm.memory_usage(index=False, deep=True).sum())
 
-    chunk_dfm.to_csv(os.path.join(locl_fldr, file_nm), compression='gzip', index=False, quoting=csv.QUOTE_NONNUMERIC)
+    return nbytes, {'rows': len(chunk_dfm), 'serialize_secs': round(serialize_secs, 3), 'compressed_bytes': nbytes,
+                    'frame_bytes': frame_bytes, 'compression_ratio': round(frame_bytes / max(nbytes, 1), 2),
+                    'upload_secs': round(upload_secs, 3),
+                    'upload_mb_per_sec': round(nbytes / (1024 * 1024) / upload_secs, 2), 'upload_attempts': attempts}
 
-    return 0
 
+# Record the result of one chunk in the checkpoint as soon as it comes back from a worker, and emit its metrics.
+# A chunk that still failed after its retries is collected so the others can finish, and a rerun only has to
+# resend the failures
+def record_upload(ckpt, ckpt_path, upload_res, failed):
+    file_nm, nbytes, err, chunk_metrics = upload_res
 
-# Upload a gzipped CSV chunk to S3
-def upload_to_s3(params):
-    locl_fldr, s3_bkt, file_name = params
+    if err is None:
+        emit_metric('chunk', file=file_nm, status='ok', **chunk_metrics)
+        ckpt['chunks'][file_nm] = {'state': 'uploaded', 'bytes': nbytes}
+        save_checkpoint(ckpt_path, ckpt)
+    else:
+        emit_metric('chunk', file=file_nm, status='failed', error=err)
+        failed.append((file_nm, err))
 
-    s3 = boto3.client('s3')
-    with open(os.path.join(locl_fldr, file_name), "rb") as f:
-        s3.upload_fileobj(f, s3_bkt, file_name)
 
+# Raise if any chunk failed to upload. Everything that was uploaded is in the checkpoint for the rerun
+def check_failed_uploads(failed):
+    if failed:
+        raise RuntimeError(f'{len(failed)} chunk(s) failed to upload, rerun to resend only these: {failed}')
 
-# Write chunks of CSV file in parallel to local folder and upload them to S3 in parallel.
-# The number of chunks should be at least as many as the number fo slices in Redshift.
-# Size of file preferably between 1-125 MB
-def write_df_to_csv_and_upload_to_s3_parallel(dfm, out_fil_pref, pl_siz, locl_fldr, s3_bkt):
-    num_slices = 8
-    total_rows = len(dfm)
-    num_chunks = max(dfm.memory_usage().sum()/(128 * 1024 * 1024), num_slices)
-    chunk_size = total_rows // num_chunks
 
-    # Create lists for the chunks to be written and the gzipped files to be uploaded to S3
-    chunk_start = 0
-    chunk_end = chunk_start + chunk_size
+# Write one chunk and upload it to S3 as soon as it has been compressed. This runs in the pool workers, so
+# while one worker is compressing its chunk (CPU bound) others are uploading theirs (network bound).
+# Errors are returned rather than raised so that one bad chunk doesn't stop the rest of the stage
+def write_and_upload_chunk(params):
+    s3_bkt, file_nm, chunk_start, chunk_end, stage_fmt, codec, src_key = params
+
+    try:
+        nbytes, chunk_metrics = encode_and_upload(get_chunk(chunk_start, chunk_end, src_key), s3_bkt, file_nm,
+                                                  stage_fmt, codec)
+    except Exception as ex:
+        return file_nm, None, repr(ex), None
+
+    return file_nm, nbytes, None, chunk_metrics
+
+
+# Plan the chunks of a dataframe and load its checkpoint. Returns the checkpoint and the parameters of the chunks
+# still to be written and uploaded, leaving out any uploaded by a previous run. src_key is the key of the
+# dataframe in the worker sources when it is one of a batch
+def plan_df_upload(dfm, out_fil_pref, s3_bkt, stage_fmt, codec, num_slices, ckpt_path=None, fingerprint=None,
+                   min_file_bytes=MIN_FILE_BYTES, src_key=None):
+    with timed_stage('plan', prefix=out_fil_pref, slices=num_slices) as stage_fields:
+        bytes_per_row = estimate_bytes_per_row(dfm, stage_fmt, codec)
+        chunk_ranges = plan_chunks(len(dfm), bytes_per_row, num_slices, min_file_bytes, MAX_FILE_BYTES)
+        stage_fields.update({'chunks': len(chunk_ranges), 'est_bytes_per_row': round(bytes_per_row, 1)})
+
+    if ckpt_path and fingerprint is None:
+        fingerprint = df_fingerprint(dfm)
+
+    plan = {'fingerprint': fingerprint, 'prefix': out_fil_pref, 'stage_fmt': stage_fmt, 'codec': codec,
+            'chunks': [list(chunk_range) for chunk_range in chunk_ranges]}
+    ckpt = load_checkpoint(ckpt_path, plan)
+
+    file_ext = stage_file_ext(stage_fmt, codec)
+
     chunk_list = []
-    upload_list = []
-    chunk_num = 0
+    for chunk_num, (chunk_start, chunk_end) in enumerate(chunk_ranges):
+        file_name = stage_key(out_fil_pref, ckpt['run_id'], chunk_num, file_ext)
+        if file_name not in ckpt['chunks']:
+            chunk_list.append((s3_bkt, file_name, chunk_start, chunk_end, stage_fmt, codec, src_key))
+
+    return ckpt, chunk_list
+
+
+# Write chunks of CSV (or Parquet) file in parallel and upload each one to S3 as soon as it is written.
+# The chunks are sized by plan_chunks from the slice count of the cluster (queried if num_slices is not given)
+# and the measured compressed size of a sample of the rows.
+# hand_off 'fork' lets the forked workers inherit the dataframe copy-on-write. 'shm' puts it in shared memory
+# as Arrow buffers, for platforms without fork. Either way only the row offsets of each chunk are sent.
+# stage_fmt and codec should already have been checked with resolve_stage_format. stage_fmt is 'csv' (pandas),
+# 'arrow_csv' or 'parquet'. codec is e.g. gzip-1, zstd, bzip2 or lzop for CSV and snappy or zstd for Parquet.
+# With a checkpoint, a rerun for the same data skips the chunks that were already uploaded.
+# min_file_bytes of 0 gives exactly one chunk per slice for small data, e.g. to benchmark chunk counts.
+# Returns (file name, bytes) of every staged file, for the COPY manifest
+def write_df_to_csv_and_upload_to_s3_parallel(dfm, out_fil_pref, pl_siz, s3_bkt, hand_off=None,
+                                              stage_fmt='csv', codec='gzip', num_slices=None,
+                                              ckpt_path=None, fingerprint=None, min_file_bytes=MIN_FILE_BYTES):
+    if num_slices is None:
+        num_slices = get_slice_count()
+
+    if hand_off is None:
+        hand_off = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'shm'
+
+    ckpt, chunk_list = plan_df_upload(dfm, out_fil_pref, s3_bkt, stage_fmt, codec, num_slices, ckpt_path,
+                                      fingerprint, min_file_bytes)
+
+    if ckpt['chunks']:
+        print(f"Resuming run {ckpt['run_id']} from checkpoint, {len(ckpt['chunks'])} chunks already uploaded")
+    else:
+        save_checkpoint(ckpt_path, ckpt)
+
+    shm = None
+    if hand_off == 'fork':
+        set_chunk_source(dfm)
+        p = multiprocessing.get_context('fork').Pool(pl_siz, initializer=init_worker, initargs=(_s3_cfg,))
+    elif hand_off == 'shm':
+        shm = df_to_shared_memory(dfm)
+        p = multiprocessing.Pool(pl_siz, initializer=init_worker, initargs=(_s3_cfg, shm.name))
+    else:
+        raise ValueError(f"Unknown hand_off mode '{hand_off}'. Use 'fork' or 'shm'")
 
-    while chunk_end < total_rows:
-        if chunk_end > total_rows:
-            chunk_end = total_rows
+    try:
+        # Write and upload the chunks as a single pipelined stage. There is no barrier between compressing and
+        # uploading, each file is picked up as soon as a worker has finished with it
+        failed = []
+        for upload_res in p.imap_unordered(write_and_upload_chunk, chunk_list):
+            record_upload(ckpt, ckpt_path, upload_res, failed)
 
-        file_name = out_fil_pref + '_' + str(chunk_num) + '.gz'
-        chunk_list.append((locl_fldr, file_name, dfm.iloc[chunk_start:chunk_end]))
-        upload_list.append((locl_fldr, s3_bkt, file_name))
+        p.close()
+        p.join()
+    finally:
+        p.terminate()
+        set_chunk_source(None)
+        if shm is not None:
+            shm.close()
+            shm.unlink()
 
-        chunk_start = chunk_end
-        chunk_end += chunk_size
-        chunk_num += 1
+    check_failed_uploads(failed)
 
-    # Clean up local folder of any previously generated files
-    shutil.rmtree(locl_fldr, ignore_errors=True)
-    os.makedirs(locl_fldr, exist_ok=True)
+    return [(file_nm, chunk['bytes']) for file_nm, chunk in ckpt['chunks'].items()]
 
-    # Clean up S3 folder of files from any previous loads
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(s3_bkt)
-    bucket.objects.all().delete()
 
-    p = multiprocessing.Pool(pl_siz)
+# Get the format of a source file from its extension
+def source_format(file_path):
+    return 'parquet' if file_path.lower().endswith(('.parquet', '.pq')) else 'csv'
 
-    # Write CSV chunks to local folder in parallel
-    _ = p.map(write_df_to_csv, chunk_list)
 
-    # Upload CSV chunks from local folder to S3 in parallel
-    _ = p.map(upload_to_s3, upload_list)
-    p.close()
-    p.join()
+# Read only the first rows of a source file. Enough to create the table and check the staging format
+def read_source_head(file_path, nrows, read_kwargs=None):
+    if source_format(file_path) == 'parquet':
+        return next(pq.ParquetFile(file_path).iter_batches(batch_size=nrows)).to_pandas()
 
-    shutil.rmtree(locl_fldr, ignore_errors=True)
+    return pd.read_csv(file_path, nrows=nrows, **(read_kwargs or {}))
 
-    return upload_list
 
+# Make a batch read later in the file match the dtypes of the first batch. An integer column that has NULLs
+# only in a later batch is read as float, and would be written to CSV as 1.0 which COPY won't load into an
+# integer column. Converting it to the nullable Int64 dtype fails if the values aren't whole numbers
+def align_batch_dtypes(batch, ref_dtypes):
+    for col, ref_dtyp in ref_dtypes.items():
+        dtyp = batch[col].dtype
+        if pd.api.types.is_integer_dtype(ref_dtyp) and pd.api.types.is_float_dtype(dtyp):
+            batch[col] = batch[col].astype('Int64')
 
-# Delete the table created by to_sql to remove the one row used to create the table
-def delete_table(schm_nm, tbl_nm):
-    conn = create_redshift_conn()
+    return batch
 
-    conn.cursor().execute(f"DELETE FROM {schm_nm}.{tbl_nm}")
 
-    conn.commit()
-    conn.close()
+# Read a CSV source file in batches of batch_rows rows
+def iter_csv_batches(file_path, batch_rows, read_kwargs):
+    ref_dtypes = None
 
-    return 0
+    for batch in pd.read_csv(file_path, chunksize=batch_rows, **read_kwargs):
+        if ref_dtypes is None:
+            ref_dtypes = batch.dtypes
+        else:
+            batch = align_batch_dtypes(batch, ref_dtypes)
 
+        yield batch
 
-# Load the files uploaded to S3 to the Redshift table. This will do a parallel
-# load as we are providing a prefix to the COPY command. A manifest file could
-# be used instead
-def load_data_to_redshift_parallel(s3_bkt, file_prefix, schm_nm, tbl_nm):
-    iam_role = get_secret_iam_role().strip()
 
-    conn = create_redshift_conn()
+# Group the row groups of a Parquet source file into batches of at least batch_rows rows. Only the row group
+# numbers are sent to the workers, which read the row groups from the file themselves
+def iter_parquet_row_groups(file_path, batch_rows):
+    pq_meta = pq.ParquetFile(file_path).metadata
+
+    row_grps = []
+    grp_rows = 0
+    for rg_num in range(pq_meta.num_row_groups):
+        row_grps.append(rg_num)
+        grp_rows += pq_meta.row_group(rg_num).num_rows
+
+        if grp_rows >= batch_rows:
+            yield row_grps
+            row_grps = []
+            grp_rows = 0
+
+    if row_grps:
+        yield row_grps
+
+
+# Write one batch of a streamed source and upload it to S3. The batch is either a dataframe parsed by the
+# parent or a list of row groups of a Parquet file, read here. Errors are returned as for write_and_upload_chunk
+def write_and_upload_batch(params):
+    s3_bkt, file_nm, batch, file_path, stage_fmt, codec = params
+
+    try:
+        if isinstance(batch, list):
+            batch = pq.ParquetFile(file_path).read_row_groups(batch).to_pandas()
+
+        nbytes, chunk_metrics = encode_and_upload(batch, s3_bkt, file_nm, stage_fmt, codec)
+    except Exception as ex:
+        return file_nm, None, repr(ex), None
+
+    return file_nm, nbytes, None, chunk_metrics
+
+
+# Load the checkpoint of a streamed source file and read it in batches. Returns the checkpoint and a generator of
+# the parameters of the batches still to be written and uploaded. Batches are only read as the generator is
+# consumed, and the ones uploaded by a previous run are skipped
+def plan_stream_upload(file_path, out_fil_pref, s3_bkt, batch_rows, stage_fmt, codec, read_kwargs=None,
+                       ckpt_path=None):
+    plan = {'fingerprint': file_fingerprint(file_path), 'prefix': out_fil_pref, 'stage_fmt': stage_fmt,
+            'codec': codec, 'batch_rows': batch_rows}
+    ckpt = load_checkpoint(ckpt_path, plan)
+
+    file_ext = stage_file_ext(stage_fmt, codec)
+
+    def batch_params():
+        if source_format(file_path) == 'parquet':
+            batches = iter_parquet_row_groups(file_path, batch_rows)
+        else:
+            batches = iter_csv_batches(file_path, batch_rows, read_kwargs or {})
+
+        for chunk_num, batch in enumerate(batches):
+            file_name = stage_key(out_fil_pref, ckpt['run_id'], chunk_num, file_ext)
+            if file_name not in ckpt['chunks']:
+                yield s3_bkt, file_name, batch, file_path, stage_fmt, codec
+
+    return ckpt, batch_params()
+
+
+# Stream a CSV or Parquet source file straight to S3 without loading it into a dataframe. The file is read in
+# batches of batch_rows rows and each batch becomes one staged file, fed to the same write and upload stage as
+# the dataframe path. At most max_inflight batches are waiting for a worker at any time, so memory stays flat
+# however big the file is. Choose batch_rows so that the staged files are within 1-125 MB compressed.
+# With a checkpoint, a rerun for the same file skips the batches that were already uploaded. A CSV file is
+# still parsed up to the point of the missing batches, but they are not encoded or uploaded again
+def stream_file_to_s3_parallel(file_path, out_fil_pref, pl_siz, s3_bkt, batch_rows=1000000, stage_fmt='csv',
+                               codec='gzip', read_kwargs=None, max_inflight=None, ckpt_path=None):
+    if max_inflight is None:
+        max_inflight = 2 * pl_siz
+
+    ckpt, batch_list = plan_stream_upload(file_path, out_fil_pref, s3_bkt, batch_rows, stage_fmt, codec,
+                                          read_kwargs, ckpt_path)
+
+    if ckpt['chunks']:
+        print(f"Resuming run {ckpt['run_id']} from checkpoint, {len(ckpt['chunks'])} batches already uploaded")
+    else:
+        save_checkpoint(ckpt_path, ckpt)
+
+    p = multiprocessing.Pool(pl_siz, initializer=init_worker, initargs=(_s3_cfg,))
+
+    try:
+        failed = []
+        pending = collections.deque()
+
+        for batch_params in batch_list:
+            # Wait for the oldest batch to finish before reading more of the file
+            if len(pending) >= max_inflight:
+                record_upload(ckpt, ckpt_path, pending.popleft().get(), failed)
+
+            pending.append(p.apply_async(write_and_upload_batch, (batch_params,)))
+
+        while pending:
+            record_upload(ckpt, ckpt_path, pending.popleft().get(), failed)
+
+        p.close()
+        p.join()
+    finally:
+        p.terminate()
+
+    check_failed_uploads(failed)
+
+    return [(file_nm, chunk['bytes']) for file_nm, chunk in ckpt['chunks'].items()]
+
+
+# Write the COPY manifest listing exactly the files staged for this load, under the prefix of the run. COPY
+# fails if any of them is missing instead of loading whatever happens to be under the prefix. content_length
+# is required by Parquet COPY
+def write_manifest(s3_bkt, upload_list):
+    manifest = {'entries': [{'url': f's3://{s3_bkt}/{file_nm}', 'mandatory': True,
+                             'meta': {'content_length': nbytes}} for file_nm, nbytes in upload_list]}
+
+    manifest_key = run_prefix_of(upload_list) + 'load.manifest'
+    upload_to_s3(io.BytesIO(json.dumps(manifest).encode('utf-8')), s3_bkt, manifest_key)
 
-    # For the small amount of data in this sample, the Redshift parallel load time isn't all that
-    # different whether there is one file (loaded by one slice) or multiple files (loaded by multiple
-    # slices in parallel), but for large data sets, it will make a large difference
-    conn.cursor().execute(f"""COPY {schm_nm}.{tbl_nm}
-                              FROM 's3://{s3_bkt}/{file_prefix}'
-                              IAM_ROLE '{iam_role}'
-                              FORMAT CSV
-                              IGNOREHEADER 1
-                              GZIP""")
+    return manifest_key
 
-    conn.commit()
-    conn.close()
 
-    return 0
+# Get the Redshift type for a pandas integer dtype. Unsigned types need the next bigger signed type
+def redshift_int_type(dtyp):
+    nbits = dtyp.itemsize * 8 + (1 if pd.api.types.is_unsigned_integer_dtype(dtyp) else 0)
+
+    if nbits <= 16:
+        return 'SMALLINT'
+    if nbits <= 32:
+        return 'INTEGER'
+    if nbits <= 64:
+        return 'BIGINT'
+
+    return 'DECIMAL(20, 0)'
+
+
+# Get the size of a VARCHAR column from the longest value in bytes, which is what Redshift VARCHAR lengths
+# count. 'max' gives the maximum length, for when only a sample of the data has been seen
+def redshift_varchar_type(col_srs, varchar_sizing):
+    if varchar_sizing == 'max':
+        return f'VARCHAR({MAX_VARCHAR_BYTES})'
+
+    max_bytes = col_srs.dropna().astype(str).str.encode('utf-8').str.len().max()
+    if pd.isna(max_bytes):
+        max_bytes = 1
+
+    return f'VARCHAR({min(max(int(max_bytes), 1), MAX_VARCHAR_BYTES)})'
+
+
+# Get the Redshift column type for a dataframe column
+def redshift_col_type(col_srs, varchar_sizing='observed'):
+    dtyp = col_srs.dtype
+
+    if isinstance(dtyp, pd.CategoricalDtype):
+        return redshift_col_type(col_srs.astype(dtyp.categories.dtype), varchar_sizing)
+    if pd.api.types.is_bool_dtype(dtyp):
+        return 'BOOLEAN'
+    if pd.api.types.is_integer_dtype(dtyp):
+        return redshift_int_type(dtyp)
+    if pd.api.types.is_float_dtype(dtyp):
+        return 'REAL' if dtyp.itemsize == 4 else 'DOUBLE PRECISION'
+    if pd.api.types.is_datetime64_any_dtype(dtyp):
+        return 'TIMESTAMPTZ' if getattr(dtyp, 'tz', None) is not None else 'TIMESTAMP'
+
+    if dtyp == object:
+        inferred = pd.api.types.infer_dtype(col_srs, skipna=True)
+        if inferred in OBJECT_COL_TYPES:
+            return OBJECT_COL_TYPES[inferred]
+
+    return redshift_varchar_type(col_srs, varchar_sizing)
+
+
+# Generate the CREATE TABLE statement for a dataframe. The column types come from the dtypes (col_types can
+# override any of them), VARCHARs are sized from the longest value, and col_encodings gives the ENCODE of any
+# column, e.g. {'trade_id': 'AZ64', 'comment': 'ZSTD'}. dist_key and sort_keys set the distribution and
+# compound sort key. if_not_exists leaves an existing table alone
+def generate_create_table_ddl(dfm, schm_nm, tbl_nm, dist_key=None, sort_keys=None, col_encodings=None,
+                              col_types=None, varchar_sizing='observed', if_not_exists=False):
+    col_encodings = col_encodings or {}
+    col_types = col_types or {}
+
+    col_defs = []
+    for col in dfm.columns:
+        col_def = f'{quote_ident(col)} {col_types.get(col) or redshift_col_type(dfm[col], varchar_sizing)}'
+        if col in col_encodings:
+            col_def += f' ENCODE {col_encodings[col]}'
+        col_defs.append(col_def)
+
+    create_cmd = 'CREATE TABLE IF NOT EXISTS' if if_not_exists else 'CREATE TABLE'
+    ddl = f'{create_cmd} {schm_nm}.{tbl_nm} (\n    ' + ',\n    '.join(col_defs) + '\n)'
+
+    if dist_key:
+        ddl += f'\nDISTSTYLE KEY DISTKEY ({quote_ident(dist_key)})'
+    if sort_keys:
+        ddl += '\nCOMPOUND SORTKEY (' + ', '.join(quote_ident(col) for col in sort_keys) + ')'
+
+    return ddl
+
+
+# Create (or replace) the table for a dataframe with one DDL statement on the pooled connection, instead of
+# creating it with a one row to_sql through SQLAlchemy and deleting the row again over a second connection.
+# The drop and create are in one transaction. With replace=False an existing table is kept, e.g. to merge into.
+# Takes the same options as generate_create_table_ddl
+def create_table(dfm, schm_nm, tbl_nm, replace=True, **ddl_opts):
+    ddl = generate_create_table_ddl(dfm, schm_nm, tbl_nm, if_not_exists=not replace, **ddl_opts)
+
+    with redshift_conn() as conn:
+        cur = conn.cursor()
+        if replace:
+            cur.execute(f"DROP TABLE IF EXISTS {schm_nm}.{tbl_nm}")
+        cur.execute(ddl)
+        conn.commit()
+
+    return ddl
+
+
+# Format options of the COPY command for the format and codec the chunks were staged in. Parquet files carry
+# their compression in the file. Timestamps written by the pyarrow CSV writer end in Z, read by TIMEFORMAT auto
+def copy_format_clause(stage_fmt, codec='gzip'):
+    if stage_fmt == 'parquet':
+        return "FORMAT AS PARQUET"
+
+    copy_opts = f"FORMAT CSV IGNOREHEADER 1 {COPY_CSV_COMPRESSION[split_codec(codec)[0]]}".rstrip()
+    if stage_fmt == 'arrow_csv':
+        copy_opts += " TIMEFORMAT 'auto'"
+
+    return copy_opts
+
+
+# Build the COPY command that loads the files in the manifest into a table
+def build_copy_sql(s3_bkt, manifest_key, target_tbl, iam_role, stage_fmt, codec='gzip'):
+    return f"""COPY {target_tbl}
+               FROM 's3://{s3_bkt}/{manifest_key}'
+               IAM_ROLE '{iam_role}'
+               {copy_format_clause(stage_fmt, codec)}
+               MANIFEST"""
+
+
+# Mark the checkpoint as loaded once the COPY has been committed, so a rerun doesn't load the data twice
+def mark_checkpoint_loaded(ckpt_path):
+    if not ckpt_path:
+        return
+
+    with open(ckpt_path, 'r') as ckpt_file:
+        ckpt = json.load(ckpt_file)
+
+    ckpt['loaded'] = True
+    save_checkpoint(ckpt_path, ckpt)
+
+
+# Load the files uploaded to S3 to the Redshift table. This will do a parallel
+# load as the manifest lists one file per chunk. The checkpoint is marked as
+# loaded once the COPY has been committed, so a rerun doesn't load the data twice.
+# Returns the number of rows loaded
+def load_data_to_redshift_parallel(s3_bkt, manifest_key, schm_nm, tbl_nm, stage_fmt='csv', codec='gzip',
+                                   ckpt_path=None):
+    iam_role = get_secret_iam_role().strip()
+
+    with redshift_conn() as conn:
+        # For the small amount of data in this sample, the Redshift parallel load time isn't all that
+        # different whether there is one file (loaded by one slice) or multiple files (loaded by multiple
+        # slices in parallel), but for large data sets, it will make a large difference
+        cur = conn.cursor()
+        cur.execute(build_copy_sql(s3_bkt, manifest_key, f'{schm_nm}.{tbl_nm}', iam_role, stage_fmt, codec))
+
+        cur.execute("SELECT pg_last_copy_count()")
+        rows_loaded = cur.fetchone()[0]
+
+        conn.commit()
+
+    mark_checkpoint_loaded(ckpt_path)
+
+    return rows_loaded
+
+
+# Build the statements that apply the rows of the staging table to the target table, matching rows on the key
+# columns. 'merge' updates the matched rows and inserts the others with one MERGE. 'delete_insert' deletes the
+# matched rows and inserts all the staged rows, for databases without MERGE. Both work in Redshift and in
+# Postgres 15+, so they can be tested against a local Postgres (benchmark_fast_save_df_to_redshift.py runs them).
+# Redshift's DELETE takes no alias for the target table, so it matches on the full table names
+def build_merge_sql(schm_nm, tbl_nm, stage_tbl, key_cols, cols, merge_method='merge'):
+    target_tbl = f'{schm_nm}.{tbl_nm}'
+    key_match = ' AND '.join(f'tgt.{quote_ident(col)} = stg.{quote_ident(col)}' for col in key_cols)
+    del_key_match = ' AND '.join(f'{target_tbl}.{quote_ident(col)} = {stage_tbl}.{quote_ident(col)}'
+                                 for col in key_cols)
+    col_list = ', '.join(quote_ident(col) for col in cols)
+    upd_cols = [col for col in cols if col not in key_cols]
+
+    # With nothing but key columns there is nothing to update
+    if merge_method == 'merge' and upd_cols:
+        upd_set = ', '.join(f'{quote_ident(col)} = stg.{quote_ident(col)}' for col in upd_cols)
+        ins_vals = ', '.join(f'stg.{quote_ident(col)}' for col in cols)
+
+        return [f"""MERGE INTO {target_tbl} AS tgt
+                    USING {stage_tbl} AS stg
+                    ON {key_match}
+                    WHEN MATCHED THEN UPDATE SET {upd_set}
+                    WHEN NOT MATCHED THEN INSERT ({col_list}) VALUES ({ins_vals})"""]
+    elif merge_method in ('merge', 'delete_insert'):
+        return [f"DELETE FROM {target_tbl} USING {stage_tbl} WHERE {del_key_match}",
+                f"INSERT INTO {target_tbl} ({col_list}) SELECT {col_list} FROM {stage_tbl}"]
+
+    raise ValueError(f"Unknown merge_method '{merge_method}'. Use 'merge' or 'delete_insert'")
+
+
+# Merge the files uploaded to S3 into the Redshift table on the key columns. The files are loaded in parallel
+# into a temporary staging table with the same columns as the target, and the change is applied to the target
+# in the same transaction, so readers see either none or all of it. The staged rows must be unique on the keys.
+# Returns the number of rows staged
+def merge_data_to_redshift_parallel(s3_bkt, manifest_key, schm_nm, tbl_nm, key_cols, cols, stage_fmt='csv',
+                                    codec='gzip', merge_method='merge', ckpt_path=None):
+    iam_role = get_secret_iam_role().strip()
+    stage_tbl = f'{tbl_nm}_stage'
+
+    with redshift_conn() as conn:
+        cur = conn.cursor()
+
+        cur.execute(f"CREATE TEMP TABLE {stage_tbl} (LIKE {schm_nm}.{tbl_nm})")
+        cur.execute(build_copy_sql(s3_bkt, manifest_key, stage_tbl, iam_role, stage_fmt, codec))
+
+        cur.execute("SELECT pg_last_copy_count()")
+        rows_staged = cur.fetchone()[0]
+
+        for merge_sql in build_merge_sql(schm_nm, tbl_nm, stage_tbl, key_cols, cols, merge_method):
+            cur.execute(merge_sql)
+
+        # The pooled connection outlives this load, so don't leave the temporary table behind in its session
+        cur.execute(f"DROP TABLE {stage_tbl}")
+
+        conn.commit()
+
+    mark_checkpoint_loaded(ckpt_path)
+
+    return rows_staged
+
+
+# Get the first rows, staging format and codec and the chunks left to upload of one job of a batch. The
+# format is picked by the auto mode or checked as for a single load. A job already loaded by a previous run
+# with a checkpoint is marked done
+def prepare_batch_job(job_id, job, pl_siz, s3_bkt, num_slices, link_mb_per_sec):
+    src = job['source']
+    is_file = isinstance(src, str)
+    dfm = read_source_head(src, SAMPLE_ROWS, job.get('read_kwargs')) if is_file else src
+    prefix = job.get('prefix', f"{job['schema']}_{job['table']}")
+    ckpt_path = job.get('ckpt_path')
+
+    fingerprint = None
+    if ckpt_path:
+        fingerprint = file_fingerprint(src) if is_file else df_fingerprint(src)
+
+    stage_fmt, codec = job.get('stage_fmt', 'csv'), job.get('codec')
+    if stage_fmt == 'auto':
+        stage_fmt, codec = choose_stage_encoding(dfm, pl_siz, link_mb_per_sec)
+    stage_fmt, codec = resolve_stage_format(dfm, stage_fmt, codec)
+
+    if is_file:
+        ckpt, tasks = plan_stream_upload(src, prefix, s3_bkt, job.get('batch_rows', 1000000), stage_fmt, codec,
+                                         job.get('read_kwargs'), ckpt_path)
+    else:
+        ckpt, tasks = plan_df_upload(dfm, prefix, s3_bkt, stage_fmt, codec, num_slices, ckpt_path, fingerprint,
+                                     src_key=job_id)
+
+    return {'job': job, 'dfm': dfm, 'is_file': is_file, 'prefix': prefix, 'stage_fmt': stage_fmt, 'codec': codec,
+            'ckpt': ckpt, 'tasks': tasks, 'pending': 0, 'submitted': False, 'failed': [], 'copy': None,
+            'done': checkpoint_loaded(ckpt_path, fingerprint)}
+
+
+# Check the spec of one job of a batch before anything of the batch is uploaded, so a bad spec fails the batch
+# at once rather than after its chunks are staged and its table created. Raises a ValueError naming the job
+def check_batch_job(job_id, job):
+    job_nm = f"{job_id} ({job.get('schema')}.{job.get('table')})"
+
+    missing = [key for key in ('source', 'schema', 'table') if key not in job]
+    if missing:
+        raise ValueError(f'Job {job_nm} of the batch has no {missing}')
+
+    load_mode = job.get('load_mode', 'replace')
+    if load_mode not in LOAD_MODES:
+        raise ValueError(f"Unknown load_mode '{load_mode}' of job {job_nm}. Use one of {LOAD_MODES}")
+
+    if load_mode == 'merge':
+        if not job.get('merge_keys'):
+            raise ValueError(f'Job {job_nm} is in merge mode but has no merge_keys')
+        if job.get('merge_method', 'merge') not in MERGE_METHODS:
+            raise ValueError(f"Unknown merge_method '{job['merge_method']}' of job {job_nm}. "
+                             f"Use one of {MERGE_METHODS}")
+
+
+# Create the table of one job of a batch and load its staged files. Runs in the COPY threads, once every chunk
+# of the job has been uploaded. The table is only replaced once its data is ready to load. The staged files are
+# deleted in the background after the COPY. Returns rows loaded
+def copy_batch_job(job_state, s3_bkt):
+    job = job_state['job']
+    load_mode = job.get('load_mode', 'replace')
+    ckpt_path = job.get('ckpt_path')
+    uploaded = [(file_nm, chunk['bytes']) for file_nm, chunk in job_state['ckpt']['chunks'].items()]
+
+    with timed_stage('copy', table=job['table'], load_mode=load_mode) as copy_fields:
+        create_table(job_state['dfm'], job['schema'], job['table'], replace=load_mode == 'replace',
+                     varchar_sizing='max' if job_state['is_file'] else 'observed', **job.get('ddl_opts', {}))
+
+        rows_loaded = 0
+        if uploaded:
+            manifest_key = write_manifest(s3_bkt, uploaded)
+            if load_mode == 'merge':
+                rows_loaded = merge_data_to_redshift_parallel(
+                    s3_bkt, manifest_key, job['schema'], job['table'], job['merge_keys'],
+                    list(job_state['dfm'].columns), stage_fmt=job_state['stage_fmt'], codec=job_state['codec'],
+                    merge_method=job.get('merge_method', 'merge'), ckpt_path=ckpt_path)
+            else:
+                rows_loaded = load_data_to_redshift_parallel(
+                    s3_bkt, manifest_key, job['schema'], job['table'], stage_fmt=job_state['stage_fmt'],
+                    codec=job_state['codec'], ckpt_path=ckpt_path)
+            cleanup_run_async(s3_bkt, run_prefix_of(uploaded))
+        copy_fields['rows_loaded'] = rows_loaded
+
+    return rows_loaded
+
+
+# Load many dataframes or source files into their tables on one shared pool, e.g. for a nightly run of dozens
+# of tables. Each job is a dictionary with 'source' (a dataframe, or the path of a CSV or Parquet file to
+# stream), 'schema' and 'table', and optionally 'prefix', 'stage_fmt', 'codec', 'load_mode', 'merge_keys',
+# 'merge_method', 'ddl_opts' (options of generate_create_table_ddl), 'batch_rows', 'read_kwargs' and
+# 'ckpt_path', as for a single load.
+# The chunks of every job are encoded and uploaded by the same workers, so the pool, the S3 clients and the
+# secrets are set up once for the batch. The dataframes are handed to the workers as a dictionary by job.
+# As soon as the last chunk of a job is uploaded its table is created and loaded in a COPY thread, with up to
+# max_concurrent_copies COPYs running at once, while the workers carry on with the chunks of the other jobs.
+# A failed job doesn't stop the others, but every job spec is checked before anything is uploaded.
+# Returns the result of each job, with its rows loaded or its error
+def load_tables_parallel(jobs, pl_siz, s3_bkt, max_concurrent_copies=4, hand_off=None, num_slices=None,
+                         link_mb_per_sec=None, max_inflight=None):
+    for job_id, job in enumerate(jobs):
+        check_batch_job(job_id, job)
+
+    if num_slices is None:
+        num_slices = get_slice_count()
+    if hand_off is None:
+        hand_off = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'shm'
+    if max_inflight is None:
+        max_inflight = 2 * pl_siz
+
+    prefixes = [job.get('prefix', f"{job['schema']}_{job['table']}") for job in jobs]
+    if len(set(prefixes)) != len(prefixes):
+        raise ValueError('Every job of a batch needs its own prefix')
+
+    # The link speed is measured once for all the jobs left to the auto mode
+    if link_mb_per_sec is None and any(job.get('stage_fmt') == 'auto' for job in jobs):
+        link_mb_per_sec = measure_link_speed(s3_bkt, pl_siz)
+
+    job_states = [prepare_batch_job(job_id, job, pl_siz, s3_bkt, num_slices, link_mb_per_sec)
+                  for job_id, job in enumerate(jobs)]
+
+    for job_state in job_states:
+        save_checkpoint(job_state['job'].get('ckpt_path'), job_state['ckpt'])
+
+    df_srcs = {job_id: job_state['dfm'] for job_id, job_state in enumerate(job_states)
+               if not job_state['is_file'] and not job_state['done']}
+
+    shms = {}
+    if hand_off == 'fork':
+        set_chunk_source(df_srcs)
+        p = multiprocessing.get_context('fork').Pool(pl_siz, initializer=init_worker, initargs=(_s3_cfg,))
+    elif hand_off == 'shm':
+        shms = {job_id: df_to_shared_memory(dfm) for job_id, dfm in df_srcs.items()}
+        p = multiprocessing.Pool(pl_siz, initializer=init_worker,
+                                 initargs=(_s3_cfg, {job_id: shm.name for job_id, shm in shms.items()}))
+    else:
+        raise ValueError(f"Unknown hand_off mode '{hand_off}'. Use 'fork' or 'shm'")
+
+    # Results come back from the workers through this queue in the order they finish, whatever the job
+    done_q = queue.Queue()
+    inflight = {'batches': 0}
+    copy_executor = ThreadPoolExecutor(max_workers=max_concurrent_copies)
+
+    # Start the COPY of a job once all its chunks have been submitted and have come back
+    def finish_if_uploaded(job_state):
+        if job_state['submitted'] and job_state['pending'] == 0 and job_state['copy'] is None:
+            if job_state['failed']:
+                emit_metric('stage', stage='copy', table=job_state['job']['table'], status='failed',
+                            error=f"{len(job_state['failed'])} chunk(s) failed to upload")
+            else:
+                job_state['copy'] = copy_executor.submit(copy_batch_job, job_state, s3_bkt)
+
+    def handle_result():
+        job_id, upload_res = done_q.get()
+        job_state = job_states[job_id]
+
+        record_upload(job_state['ckpt'], job_state['job'].get('ckpt_path'), upload_res, job_state['failed'])
+        job_state['pending'] -= 1
+        if job_state['is_file']:
+            inflight['batches'] -= 1
+
+        finish_if_uploaded(job_state)
+
+    def submit(job_id, task_fn, params):
+        p.apply_async(task_fn, (params,), callback=lambda res: done_q.put((job_id, res)),
+                      error_callback=lambda ex: done_q.put((job_id, (params[1], None, repr(ex), None))))
+        job_states[job_id]['pending'] += 1
+
+    try:
+        # Chunks of dataframes are only row offsets, so they are all queued at once. File batches are read as
+        # the workers free up, with at most max_inflight of them waiting at any time
+        for job_id, job_state in enumerate(job_states):
+            if not job_state['done'] and not job_state['is_file']:
+                for chunk_params in job_state['tasks']:
+                    submit(job_id, write_and_upload_chunk, chunk_params)
+                job_state['submitted'] = True
+                finish_if_uploaded(job_state)
+
+        for job_id, job_state in enumerate(job_states):
+            if not job_state['done'] and job_state['is_file']:
+                for batch_params in job_state['tasks']:
+                    while inflight['batches'] >= max_inflight:
+                        handle_result()
+                    submit(job_id, write_and_upload_batch, batch_params)
+                    inflight['batches'] += 1
+                job_state['submitted'] = True
+                finish_if_uploaded(job_state)
+
+        while any(job_state['pending'] for job_state in job_states):
+            handle_result()
+
+        p.close()
+        p.join()
+
+        results = []
+        for job_state in job_states:
+            job = job_state['job']
+            job_res = {'schema': job['schema'], 'table': job['table'], 'status': 'ok', 'rows_loaded': None}
+
+            if job_state['done']:
+                job_res['status'] = 'skipped'
+            elif job_state['failed']:
+                job_res.update({'status': 'failed', 'error': f"Chunks failed to upload: {job_state['failed']}"})
+            else:
+                try:
+                    job_res['rows_loaded'] = job_state['copy'].result()
+                except Exception as ex:
+                    job_res.update({'status': 'failed', 'error': repr(ex)})
+
+            results.append(job_res)
+    finally:
+        p.terminate()
+        copy_executor.shutdown(wait=True)
+        wait_for_cleanups()
+        set_chunk_source(None)
+        for shm in shms.values():
+            shm.close()
+            shm.unlink()
+
+    return results
 
 
 if __name__ == "__main__":
-    local_folder = '<<Your local folder>>'
     s3_bucket = '<<Your S3 bucket>>'
     # Place the sample dataset in some folder as the starting point
     file_path = os.path.join('/tmp', 'trade_transactions.csv')
     schema_name = '<<Your schema name>>'
     table_name = 'trade_transactions'
-    out_file_prefix = 'trade_trans'
+    out_file_prefix = 'trade_trans'  # Files are staged under <out_file_prefix>/<run ID>/
     pool_size = 8
+    stream_source = False  # Read the source file in batches instead of loading it all into a dataframe
+    batch_rows = 1000000  # Rows per staged file when streaming the source file
+    # 'csv' (pandas writer), 'arrow_csv' (pyarrow writer), 'parquet' or 'auto' to pick the fastest for the link.
+    # Parquet and arrow_csv fall back to csv for dtypes they can't stage
+    stage_format = 'csv'
+    codec = None  # e.g. 'gzip-1', 'zstd', 'bzip2' or 'lzop' for CSV, 'snappy' or 'zstd' for Parquet. Default if None
+    link_mb_per_sec = None  # Upload speed to S3 the auto mode plans for. Measured if None
+    checkpoint_path = os.path.join('/tmp', 'trade_trans.ckpt')  # Lets a failed load resume where it stopped
+    dist_key = None  # Column to distribute the table on, if any
+    sort_keys = []  # Columns of the compound sort key
+    col_encodings = {}  # Compression encoding of any column, e.g. {'trade_id': 'AZ64'}
+    load_mode = 'replace'  # 'replace' the table, or 'merge' the data into it on the merge_keys
+    merge_keys = ['trade_id']  # Key columns to match rows on in merge mode
+    merge_method = 'merge'  # 'merge' or 'delete_insert'
+    metrics_path = None  # File the metrics are appended to as JSON lines. Printed to stdout if None
     start_time = datetime.now()
+    exit_code = 0
 
-    try:
-        # Read the source data from CSV
-        df = pd.read_csv(file_path, quoting=csv.QUOTE_NONNUMERIC)
+    configure_metrics(path=metrics_path)
 
-        engine = get_engine(*get_secret_creds())
+    try:
+        with timed_stage('read_source', table=table_name) as read_fields:
+            if stream_source:
+                # Only the first rows are read up front, to create the table and check the staging format
+                df = read_source_head(file_path, SAMPLE_ROWS, {'quoting': csv.QUOTE_NONNUMERIC})
+            else:
+                # Read the source data from CSV
+                df = pd.read_csv(file_path, quoting=csv.QUOTE_NONNUMERIC)
+            read_fields['rows'] = len(df)
+
+        fingerprint = file_fingerprint(file_path) if stream_source else df_fingerprint(df)
+        if checkpoint_loaded(checkpoint_path, fingerprint):
+            print('This data was already loaded by a previous run')
+            exit(0)
 
         # Do not do this! Takes 21 minutes to load the data to table even for this relatively small dataset
+        # engine = get_engine(*get_secret_creds())
         # df.to_sql(name=table_name, schema=schema_name, con=engine, index=False, if_exists='replace',
         #           method='multi', chunksize=4000)
 
         # Do this instead. The load now takes only 45 seconds!
-        # Create a single row dataframe from df
-        df_one_row = df[0:1]
-
-        # Create the table using the one row dataframe
-        df_one_row.to_sql(name=table_name, schema=schema_name, con=engine, index=False, if_exists='replace')
-        # Delete the one row used to create the table. We will write the whole dataset including that row
-        delete_table(schema_name, table_name)
-
-        # Write chunks of CSV file in parallel to local folder and upload them to S3 in parallel
-        write_df_to_csv_and_upload_to_s3_parallel(df, out_file_prefix, pool_size, local_folder, s3_bucket)
-
-        # Load the files uploaded to S3 to the Redshift table
-        load_data_to_redshift_parallel(s3_bucket, out_file_prefix, schema_name, table_name)
+        # Create the table with column types from the dtypes. When streaming only the first rows have been
+        # read, so VARCHARs get the maximum length rather than the longest value seen
+        # In merge mode the table is only created if it doesn't exist yet
+        with timed_stage('create_table', table=table_name):
+            create_table(df, schema_name, table_name, replace=load_mode == 'replace', dist_key=dist_key,
+                         sort_keys=sort_keys, col_encodings=col_encodings,
+                         varchar_sizing='max' if stream_source else 'observed')
+
+        # Pick the staging format and codec from a sample of the rows, or check the ones given. Stage through
+        # Arrow only if all the columns can go through it
+        if stage_format == 'auto':
+            if link_mb_per_sec is None:
+                link_mb_per_sec = measure_link_speed(s3_bucket, pool_size)
+            stage_format, codec = choose_stage_encoding(df, pool_size, link_mb_per_sec)
+        stage_format, codec = resolve_stage_format(df, stage_format, codec)
+
+        with timed_stage('encode_upload', table=table_name, stage_fmt=stage_format, codec=codec) as upload_fields:
+            if stream_source:
+                # Stream the source file to S3 in batches, the whole file is never held in memory
+                uploaded = stream_file_to_s3_parallel(file_path, out_file_prefix, pool_size, s3_bucket,
+                                                      batch_rows=batch_rows, stage_fmt=stage_format, codec=codec,
+                                                      read_kwargs={'quoting': csv.QUOTE_NONNUMERIC},
+                                                      ckpt_path=checkpoint_path)
+            else:
+                # Write chunks of CSV file in parallel and upload each one to S3 as soon as it is written
+                uploaded = write_df_to_csv_and_upload_to_s3_parallel(df, out_file_prefix, pool_size, s3_bucket,
+                                                                     stage_fmt=stage_format, codec=codec,
+                                                                     ckpt_path=checkpoint_path,
+                                                                     fingerprint=fingerprint)
+            upload_fields.update({'files': len(uploaded), 'compressed_bytes': sum(nb for _, nb in uploaded)})
+
+        # Load the files uploaded to S3 to the Redshift table. Nothing to load for an empty dataframe
+        if uploaded:
+            manifest_key = write_manifest(s3_bucket, uploaded)
+            with timed_stage('copy', table=table_name, load_mode=load_mode) as copy_fields:
+                if load_mode == 'merge':
+                    copy_fields['rows_loaded'] = merge_data_to_redshift_parallel(
+                        s3_bucket, manifest_key, schema_name, table_name, merge_keys, list(df.columns),
+                        stage_fmt=stage_format, codec=codec, merge_method=merge_method, ckpt_path=checkpoint_path)
+                else:
+                    copy_fields['rows_loaded'] = load_data_to_redshift_parallel(
+                        s3_bucket, manifest_key, schema_name, table_name, stage_fmt=stage_format, codec=codec,
+                        ckpt_path=checkpoint_path)
+
+            # Delete the staged files of this run in the background, while the rest of the run finishes
+            cleanup_run_async(s3_bucket, run_prefix_of(uploaded))
     except Exception as ex:
-        print(ex)
+        # The failed stage has already been emitted with its error. Print the full traceback for the log
+        traceback.print_exc()
+        emit_metric('load', table=table_name, status='failed', error=repr(ex))
+        exit_code = 1
+    finally:
+        close_redshift_conns()
+        wait_for_cleanups()
 
     end_time = datetime.now()
     elapsed_time = end_time - start_time
     print(f'Time to write table: {elapsed_time}')
 
-    exit(0)
+    if exit_code == 0:
+        emit_metric('load', table=table_name, status='ok', secs=round(elapsed_time.total_seconds(), 3))
 
+    exit(exit_code)
@@ -0,0 +1,475 @@
+#!/usr/bin/env python
+
+"""fast_save_df_to_snowflake.py: Save a Pandas dataframe to Snowflake much faster than row inserts."""
+
+"""
+Inserting a dataframe into a Snowflake table row by row (or with executemany) is extremely slow. This script
+loads it the way the Redshift loader in fast_save_df_to_redshift.py does, sharing its chunk planning and encoding
+(df_staging.py):
+1) Break the dataframe into chunks and encode them in parallel, in memory, as compressed CSV (gzip at any level,
+   zstd or bzip2) or Parquet. The auto mode picks the fastest encoding for the link from a sample of the rows
+2) PUT each chunk to an internal stage from memory as soon as it is encoded, on several threads, so encoding and
+   uploading overlap. The files are already compressed, so PUT doesn't compress them again
+3) The number of files is a multiple of the number of files the warehouse loads at once (8 per node of the
+   warehouse size), and each file is sized to fall in Snowflake's recommended 100-250 MB compressed
+4) Load all the files with a single COPY INTO listing exactly the files of this run, which are purged from the
+   stage once they are loaded
+5) The table is created with one DDL statement generated from the dtypes
+6) The same per-stage and per-chunk metrics as the Redshift loader: serialize time, compressed bytes, PUT
+   throughput, COPY time and rows loaded
+
+A stand-in connection (LocalStageConn) keeps the stage in a local folder and loads COPY INTO into SQLite, so
+the whole load can be tried and tested without a Snowflake account.
+"""
+
+# Requires installation of snowflake-connector-python and pyarrow
+# pip install snowflake-connector-python
+# pip install pyarrow
+
+import multiprocessing
+import bz2
+import collections
+import gzip
+import io
+import os
+import re
+import sqlite3
+import time
+import traceback
+import pandas as pd
+import csv
+import pyarrow.parquet as pq
+
+from check_table_exists_snowflake import create_conn
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from df_staging import (SAMPLE_ROWS, AUTO_CANDIDATES, configure_metrics, emit_metric, timed_stage, split_codec,
+                        resolve_stage_format, encode_chunk, stage_file_ext, df_to_shared_memory, init_chunk_source,
+                        set_chunk_source, get_chunk, estimate_bytes_per_row, choose_stage_encoding, plan_chunks,
+                        UPLOAD_RETRIES, new_run_id, quote_ident)
+
+__author__ = "Arindam Sinha"
+__license__ = "GPL"
+__version__ = "1.0.0"
+__status__ = "Prototype"
+
+# Snowflake recommends compressed load files of 100-250 MB
+MIN_FILE_BYTES = 100 * 1024 * 1024
+MAX_FILE_BYTES = 250 * 1024 * 1024
+
+# Nodes of each warehouse size. Each node loads 8 files at once
+WAREHOUSE_NODES = {'X-SMALL': 1, 'SMALL': 2, 'MEDIUM': 4, 'LARGE': 8, 'X-LARGE': 16, '2X-LARGE': 32,
+                   '3X-LARGE': 64, '4X-LARGE': 128, '5X-LARGE': 256, '6X-LARGE': 512}
+# Other names of the warehouse sizes, as SHOW WAREHOUSES shows them in older accounts or as CREATE WAREHOUSE
+# takes them, upper cased
+WAREHOUSE_SIZE_NAMES = {'XSMALL': 'X-SMALL', 'XLARGE': 'X-LARGE', 'XXLARGE': '2X-LARGE', 'XX-LARGE': '2X-LARGE',
+                        'X2LARGE': '2X-LARGE', 'XXXLARGE': '3X-LARGE', 'XXX-LARGE': '3X-LARGE', 'X3LARGE': '3X-LARGE',
+                        'X4LARGE': '4X-LARGE', 'X5LARGE': '5X-LARGE', 'X6LARGE': '6X-LARGE'}
+LOAD_THREADS_PER_NODE = 8
+
+# Most files one COPY INTO can list. More are loaded by the path of the run, which holds only its own files
+MAX_COPY_FILES = 1000
+
+# COPY compression option for each codec CSV files can be compressed with. Snowflake can't read lzop
+COPY_CSV_COMPRESSION = {'gzip': 'GZIP', 'bzip2': 'BZ2', 'zstd': 'ZSTD', 'none': 'NONE'}
+# Staging formats and codecs the auto mode tries
+SNOWFLAKE_AUTO_CANDIDATES = [(stage_fmt, codec) for stage_fmt, codec in AUTO_CANDIDATES if codec != 'lzop']
+
+# Snowflake column types for object columns by pd.api.types.infer_dtype. Others are VARCHAR
+OBJECT_COL_TYPES = {'boolean': 'BOOLEAN', 'integer': 'NUMBER(38, 0)', 'floating': 'FLOAT', 'date': 'DATE',
+                    'datetime': 'TIMESTAMP_NTZ', 'decimal': 'NUMBER(38, 10)'}
+
+
+# Get the number of files the current warehouse loads at once, from its size. Neither statement needs the
+# warehouse to be running
+def get_load_threads(conn):
+    cur = conn.cursor()
+    wh_nm = cur.execute("SELECT CURRENT_WAREHOUSE()").fetchone()[0]
+
+    res = cur.execute(f"SHOW WAREHOUSES LIKE '{wh_nm}'")
+    size_col = [col[0].lower() for col in res.description].index('size')
+    wh_size = res.fetchone()[size_col].upper()
+    wh_size = WAREHOUSE_SIZE_NAMES.get(wh_size, wh_size)
+
+    if wh_size not in WAREHOUSE_NODES:
+        print(f"Unknown size '{wh_size}' of warehouse {wh_nm}. Loading as for an X-Small warehouse")
+
+    return WAREHOUSE_NODES.get(wh_size, 1) * LOAD_THREADS_PER_NODE
+
+
+# Encode one chunk in a pool worker. The encoded file is sent back to be PUT by the threads of the parent, which
+# share its one connection. Errors are returned rather than raised so that one bad chunk doesn't stop the rest
+def encode_chunk_worker(params):
+    file_nm, chunk_start, chunk_end, stage_fmt, codec = params
+
+    try:
+        chunk_dfm = get_chunk(chunk_start, chunk_end)
+
+        encode_start = time.perf_counter()
+        data = encode_chunk(chunk_dfm, stage_fmt, codec).getvalue()
+        serialize_secs = time.perf_counter() - encode_start
+
+        frame_bytes = int(chunk_dfm.memory_usage(index=False, deep=True).sum())
+    except Exception as ex:
+        return file_nm, None, repr(ex), None
+
+    return file_nm, data, None, {'rows': chunk_end - chunk_start, 'serialize_secs': round(serialize_secs, 3),
+                                 'compressed_bytes': len(data), 'frame_bytes': frame_bytes,
+                                 'compression_ratio': round(frame_bytes / max(len(data), 1), 2)}
+
+
+# PUT one encoded chunk to the stage from memory, retrying with backoff. The file is already compressed, so
+# PUT is told not to compress it again. Returns the time of the PUT that succeeded and the number of attempts
+def put_with_retry(conn, data, stage_path, file_nm):
+    for attempt in range(UPLOAD_RETRIES + 1):
+        try:
+            put_start = time.perf_counter()
+            conn.cursor().execute(f"PUT 'file://{file_nm}' '@{stage_path}' AUTO_COMPRESS = FALSE "
+                                  f"SOURCE_COMPRESSION = AUTO_DETECT OVERWRITE = TRUE", file_stream=io.BytesIO(data))
+
+            return max(time.perf_counter() - put_start, 1e-6), attempt + 1
+        except Exception:
+            if attempt == UPLOAD_RETRIES:
+                raise
+
+            time.sleep(2 ** attempt)
+
+
+# PUT an encoded chunk in a PUT thread and emit its metrics. Returns the file name and size, or the error
+def put_chunk(conn, stage_path, encode_res):
+    file_nm, data, err, chunk_metrics = encode_res
+
+    if err is None:
+        try:
+            upload_secs, attempts = put_with_retry(conn, data, stage_path, file_nm)
+        except Exception as ex:
+            err = repr(ex)
+
+    if err is not None:
+        emit_metric('chunk', file=file_nm, status='failed', error=err)
+        return file_nm, None, err
+
+    emit_metric('chunk', file=file_nm, status='ok', upload_secs=round(upload_secs, 3),
+                upload_mb_per_sec=round(len(data) / (1024 * 1024) / upload_secs, 2), upload_attempts=attempts,
+                **chunk_metrics)
+
+    return file_nm, len(data), None
+
+
+# Encode chunks of the dataframe in parallel and PUT each one to the stage as soon as it is encoded. Encoding
+# (CPU bound) runs in the pool workers and PUT (network bound) on put_threads threads of this process. At most
+# 2 * put_threads encoded chunks wait for a PUT thread, so memory stays bounded if the link is the bottleneck.
+# The chunks are sized by plan_chunks from the number of files the warehouse loads at once (queried if
+# load_threads is not given) and the measured compressed size of a sample of the rows.
+# hand_off 'fork' lets the forked workers inherit the dataframe copy-on-write, 'shm' puts it in shared memory.
+# stage_nm is e.g. '%trade_transactions' for the table stage or 'my_stage' for a named internal stage.
+# Returns the path the files were staged under and (file name, bytes) of every staged file
+def write_df_to_stage_parallel(conn, dfm, stage_nm, out_fil_pref, pl_siz, put_threads=8, stage_fmt='csv',
+                               codec='gzip', load_threads=None, hand_off=None, min_file_bytes=MIN_FILE_BYTES):
+    if load_threads is None:
+        load_threads = get_load_threads(conn)
+    if hand_off is None:
+        hand_off = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'shm'
+
+    with timed_stage('plan', prefix=out_fil_pref, slices=load_threads) as stage_fields:
+        bytes_per_row = estimate_bytes_per_row(dfm, stage_fmt, codec)
+        chunk_ranges = plan_chunks(len(dfm), bytes_per_row, load_threads, min_file_bytes, MAX_FILE_BYTES)
+        stage_fields.update({'chunks': len(chunk_ranges), 'est_bytes_per_row': round(bytes_per_row, 1)})
+
+    stage_path = f'{stage_nm}/{out_fil_pref}/{new_run_id()}'
+    file_ext = stage_file_ext(stage_fmt, codec)
+    chunk_list = [(f'{out_fil_pref}_{chunk_num}{file_ext}', chunk_start, chunk_end, stage_fmt, codec)
+                  for chunk_num, (chunk_start, chunk_end) in enumerate(chunk_ranges)]
+
+    shm = None
+    if hand_off == 'fork':
+        set_chunk_source(dfm)
+        p = multiprocessing.get_context('fork').Pool(pl_siz)
+    elif hand_off == 'shm':
+        shm = df_to_shared_memory(dfm)
+        p = multiprocessing.Pool(pl_siz, initializer=init_chunk_source, initargs=(shm.name,))
+    else:
+        raise ValueError(f"Unknown hand_off mode '{hand_off}'. Use 'fork' or 'shm'")
+
+    put_executor = ThreadPoolExecutor(max_workers=put_threads)
+
+    try:
+        pending = collections.deque()
+        put_results = []
+
+        for encode_res in p.imap_unordered(encode_chunk_worker, chunk_list):
+            # Wait for the oldest PUT to finish before taking more encoded chunks
+            if len(pending) >= 2 * put_threads:
+                put_results.append(pending.popleft().result())
+
+            pending.append(put_executor.submit(put_chunk, conn, stage_path, encode_res))
+
+        while pending:
+            put_results.append(pending.popleft().result())
+
+        p.close()
+        p.join()
+    finally:
+        p.terminate()
+        put_executor.shutdown(wait=True)
+        set_chunk_source(None)
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+    failed = [(file_nm, err) for file_nm, _, err in put_results if err is not None]
+    if failed:
+        raise RuntimeError(f'{len(failed)} chunk(s) failed to stage: {failed}')
+
+    return stage_path, [(file_nm, nbytes) for file_nm, nbytes, _ in put_results]
+
+
+# Get the Snowflake column type for a dataframe column
+def snowflake_col_type(col_srs):
+    dtyp = col_srs.dtype
+
+    if isinstance(dtyp, pd.CategoricalDtype):
+        return snowflake_col_type(col_srs.astype(dtyp.categories.dtype))
+    if pd.api.types.is_bool_dtype(dtyp):
+        return 'BOOLEAN'
+    if pd.api.types.is_integer_dtype(dtyp):
+        return 'NUMBER(38, 0)'
+    if pd.api.types.is_float_dtype(dtyp):
+        return 'FLOAT'
+    if pd.api.types.is_datetime64_any_dtype(dtyp):
+        return 'TIMESTAMP_TZ' if getattr(dtyp, 'tz', None) is not None else 'TIMESTAMP_NTZ'
+
+    if dtyp == object:
+        inferred = pd.api.types.infer_dtype(col_srs, skipna=True)
+        if inferred in OBJECT_COL_TYPES:
+            return OBJECT_COL_TYPES[inferred]
+
+    return 'VARCHAR'
+
+
+# Generate the CREATE TABLE statement for a dataframe, with column types from the dtypes. VARCHAR needs no
+# length in Snowflake, it costs nothing over a sized one
+def generate_create_table_ddl(dfm, tbl_nm):
+    col_defs = [f'{quote_ident(col)} {snowflake_col_type(dfm[col])}' for col in dfm.columns]
+
+    return f'CREATE TABLE {tbl_nm} (\n    ' + ',\n    '.join(col_defs) + '\n)'
+
+
+# Create (or replace) the table for a dataframe
+def create_table(conn, dfm, tbl_nm, replace=True):
+    ddl = generate_create_table_ddl(dfm, tbl_nm)
+
+    cur = conn.cursor()
+    if replace:
+        cur.execute(f"DROP TABLE IF EXISTS {tbl_nm}")
+    cur.execute(ddl)
+
+    return ddl
+
+
+# File format options of COPY INTO for the format and codec the chunks were staged in. CSV written by pandas
+# quotes NULLs as "", which NULL_IF turns back into NULL. Parquet columns are matched to the table by name
+def copy_file_format(stage_fmt, codec='gzip'):
+    if stage_fmt == 'parquet':
+        return "FILE_FORMAT = (TYPE = PARQUET) MATCH_BY_COLUMN_NAME = CASE_SENSITIVE"
+
+    codec_nm = split_codec(codec)[0]
+    if codec_nm not in COPY_CSV_COMPRESSION:
+        raise ValueError(f"Snowflake can't load CSV compressed with '{codec_nm}'")
+
+    file_fmt = (f"TYPE = CSV SKIP_HEADER = 1 FIELD_OPTIONALLY_ENCLOSED_BY = '\"' "
+                f"COMPRESSION = {COPY_CSV_COMPRESSION[codec_nm]}")
+    if stage_fmt == 'csv':
+        file_fmt += " NULL_IF = ('')"
+
+    return f"FILE_FORMAT = ({file_fmt})"
+
+
+# Build the COPY INTO that loads the files of a run into a table. The files are listed, so nothing else is
+# loaded even if the path is reused. PURGE removes them from the stage once they are loaded
+def build_copy_sql(tbl_nm, stage_path, upload_list, stage_fmt, codec='gzip'):
+    copy_sql = f"COPY INTO {tbl_nm} FROM '@{stage_path}/'"
+
+    if len(upload_list) <= MAX_COPY_FILES:
+        copy_sql += " FILES = (" + ', '.join(f"'{file_nm}'" for file_nm, _ in upload_list) + ")"
+
+    return f"{copy_sql} {copy_file_format(stage_fmt, codec)} ON_ERROR = ABORT_STATEMENT PURGE = TRUE"
+
+
+# Load the staged files into the table with one COPY INTO. The warehouse loads as many files at once as it
+# has load threads. Returns the number of rows loaded
+def load_data_to_snowflake(conn, tbl_nm, stage_path, upload_list, stage_fmt='csv', codec='gzip'):
+    res = conn.cursor().execute(build_copy_sql(tbl_nm, stage_path, upload_list, stage_fmt, codec))
+
+    rows_col = [col[0].lower() for col in res.description].index('rows_loaded')
+
+    return sum(row[rows_col] for row in res.fetchall())
+
+
+# Offline stand-in for a Snowflake connection, to try the loader without an account. Files PUT to a stage are
+# written under a local folder, COPY INTO loads them into a SQLite database and everything else is run by SQLite.
+# Only the PUT and COPY INTO statements this loader generates are understood
+class LocalStageConn:
+    def __init__(self, stage_dir, db_path):
+        self.stage_dir = stage_dir
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+
+    def cursor(self):
+        return LocalStageCursor(self)
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+# Cursor of the offline stand-in connection
+class LocalStageCursor:
+    put_re = re.compile(r"PUT 'file://([^']+)' '@([^']+)'")
+    copy_re = re.compile(r"COPY INTO (\S+) FROM '@([^']+)'(?: FILES = \(([^)]*)\))?")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.description = None
+        self.rows = []
+
+    def execute(self, command, file_stream=None):
+        put_match = self.put_re.match(command)
+        copy_match = self.copy_re.match(command)
+
+        if put_match:
+            self.put(put_match.group(2), put_match.group(1), file_stream)
+        elif copy_match:
+            self.copy_into(copy_match.group(1), copy_match.group(2), copy_match.group(3), 'PURGE = TRUE' in command)
+        else:
+            db_cur = self.conn.db.execute(command)
+            self.description = db_cur.description
+            self.rows = db_cur.fetchall()
+
+        return self
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+    def stage_dir(self, stage_path):
+        return os.path.join(self.conn.stage_dir, *stage_path.strip('/').split('/'))
+
+    def put(self, stage_path, file_nm, file_stream):
+        os.makedirs(self.stage_dir(stage_path), exist_ok=True)
+        with open(os.path.join(self.stage_dir(stage_path), file_nm), 'wb') as stage_file:
+            stage_file.write(file_stream.read())
+
+        self.description = [('source',), ('target',), ('status',)]
+        self.rows = [(file_nm, file_nm, 'UPLOADED')]
+
+    def copy_into(self, tbl_nm, stage_path, files, purge):
+        stage_dir = self.stage_dir(stage_path)
+        file_nms = re.findall(r"'([^']+)'", files) if files else sorted(os.listdir(stage_dir))
+
+        self.description = [('file',), ('status',), ('rows_parsed',), ('rows_loaded',)]
+        self.rows = []
+        for file_nm in file_nms:
+            file_path = os.path.join(stage_dir, file_nm)
+            file_dfm = self.read_staged_file(file_path)
+            file_dfm.to_sql(tbl_nm.strip('"'), self.conn.db, if_exists='append', index=False)
+            self.rows.append((file_nm, 'LOADED', len(file_dfm), len(file_dfm)))
+
+            if purge:
+                os.remove(file_path)
+
+    def read_staged_file(self, file_path):
+        if file_path.endswith('.parquet'):
+            return pq.read_table(file_path).to_pandas()
+
+        with open(file_path, 'rb') as stage_file:
+            data = stage_file.read()
+
+        if file_path.endswith('.gz'):
+            data = gzip.decompress(data)
+        elif file_path.endswith('.bz2'):
+            data = bz2.decompress(data)
+        elif file_path.endswith('.zst'):
+            import zstandard
+            data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+        return pd.read_csv(io.BytesIO(data))
+
+
+if __name__ == "__main__":
+    # Place the sample dataset in some folder as the starting point
+    file_path = os.path.join('/tmp', 'trade_transactions.csv')
+    table_name = 'trade_transactions'
+    stage_name = '%' + table_name  # The table stage. Or a named internal stage
+    out_file_prefix = 'trade_trans'
+    pool_size = 8
+    put_threads = 8  # PUTs running at once
+    # 'csv' (pandas writer), 'arrow_csv' (pyarrow writer), 'parquet' or 'auto' to pick the fastest for the link
+    stage_format = 'csv'
+    codec = None  # e.g. 'gzip-1', 'zstd' or 'bzip2' for CSV, 'snappy' or 'zstd' for Parquet. Default if None
+    link_mb_per_sec = 50  # Upload speed to the stage the auto mode plans for
+    offline = True  # Use the local stand-in for the stage and the database instead of Snowflake
+    load_threads = 8 if offline else None  # Files the warehouse loads at once. From the warehouse size if None
+    metrics_path = None  # File the metrics are appended to as JSON lines. Printed to stdout if None
+    start_time = datetime.now()
+    exit_code = 0
+
+    configure_metrics(path=metrics_path)
+
+    conn = None
+    try:
+        if offline:
+            conn = LocalStageConn(os.path.join('/tmp', 'local_stage'), os.path.join('/tmp', 'local_stage.db'))
+        else:
+            # COPY INTO needs a warehouse, and the table is created in the database and schema of the connection
+            conn, _ = create_conn(warehouse='<Warehouse>', database='<Database>', schema='<Schema>')
+
+        with timed_stage('read_source', table=table_name) as read_fields:
+            # Read the source data from CSV
+            df = pd.read_csv(file_path, quoting=csv.QUOTE_NONNUMERIC)
+            read_fields['rows'] = len(df)
+
+        with timed_stage('create_table', table=table_name):
+            create_table(conn, df, table_name)
+
+        if stage_format == 'auto':
+            stage_format, codec = choose_stage_encoding(df, pool_size, link_mb_per_sec, SAMPLE_ROWS,
+                                                        SNOWFLAKE_AUTO_CANDIDATES)
+        stage_format, codec = resolve_stage_format(df, stage_format, codec)
+
+        with timed_stage('encode_upload', table=table_name, stage_fmt=stage_format, codec=codec) as upload_fields:
+            # Encode chunks in parallel and PUT each one to the stage as soon as it is encoded
+            stage_path, uploaded = write_df_to_stage_parallel(conn, df, stage_name, out_file_prefix, pool_size,
+                                                              put_threads=put_threads, stage_fmt=stage_format,
+                                                              codec=codec, load_threads=load_threads)
+            upload_fields.update({'files': len(uploaded), 'compressed_bytes': sum(nb for _, nb in uploaded)})
+
+        # Load all the staged files with one COPY INTO. Nothing to load for an empty dataframe
+        if uploaded:
+            with timed_stage('copy', table=table_name) as copy_fields:
+                copy_fields['rows_loaded'] = load_data_to_snowflake(conn, table_name, stage_path, uploaded,
+                                                                    stage_fmt=stage_format, codec=codec)
+        conn.commit()
+    except Exception as ex:
+        # The failed stage has already been emitted with its error. Print the full traceback for the log
+        traceback.print_exc()
+        emit_metric('load', table=table_name, status='failed', error=repr(ex))
+        exit_code = 1
+    finally:
+        if conn is not None:
+            conn.close()
+
+    end_time = datetime.now()
+    elapsed_time = end_time - start_time
+    print(f'Time to write table: {elapsed_time}')
+
+    if exit_code == 0:
+        emit_metric('load', table=table_name, status='ok', secs=round(elapsed_time.total_seconds(), 3))
+
+    exit(exit_code)
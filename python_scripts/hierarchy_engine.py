@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+"""hierarchy_engine.py: Answer hierarchy queries in memory and materialize a closure table to load to the warehouse."""
+
+"""
+hierarchy_recursion.sql finds a hierarchy with CONNECT BY or a recursive CTE, which joins the table once per level
+on every query. On hierarchies with millions of nodes, e.g. org or account hierarchies, that is slow and expensive.
+
+Hierarchy loads the parent child pairs once into numpy arrays and answers the queries from them, without recursion:
+- parent: the position of the parent of each node, -1 for a root
+- children in CSR form: the children of node i are child_idx[child_ptr[i]:child_ptr[i + 1]]
+- depth of each node, and its Euler tour interval tin to tout (pre-order). The subtree of a node is every node with
+  tin in its interval, so subtree and is-descendant queries are a slice or a comparison of arrays
+All of them are built level by level with vectorized numpy operations, not a loop over the nodes.
+
+closure_table materializes every (ancestor, descendant, distance) pair, including each node with itself at
+distance 0. Loaded back to the warehouse with the fast loader (fast_save_df_to_snowflake.py here), the subtree of a
+node becomes a single indexed join. See the closure table query in hierarchy_recursion.sql.
+"""
+
+# Requires numpy and pandas, and for loading the closure table the requirements of fast_save_df_to_snowflake.py
+
+import os
+import numpy as np
+import pandas as pd
+
+from check_table_exists_snowflake import create_conn
+from datetime import datetime
+from df_staging import configure_metrics, timed_stage, resolve_stage_format
+import fast_save_df_to_snowflake as fss
+
+__author__ = "Arindam Sinha"
+__license__ = "GPL"
+__version__ = "1.0.0"
+__status__ = "Prototype"
+
+
+# Read the parent child pairs of employee_dataset.csv (columns Emp Id, Name, Supervisor Emp Id, with a byte order
+# mark). Top level employees have no supervisor
+def read_employee_edges(file_path):
+    emp_df = pd.read_csv(file_path, encoding='utf-8-sig', dtype={'Emp Id': 'int64', 'Supervisor Emp Id': 'Int64'})
+
+    return emp_df.rename(columns={'Emp Id': 'employee_id', 'Name': 'employee_name',
+                                  'Supervisor Emp Id': 'supervisor_employee_id'})
+
+
+# Hierarchy of nodes held in numpy arrays. node_ids are the IDs of the nodes and parent_ids the ID of the parent of
+# each, missing (None, NaN or pd.NA) for a root
+class Hierarchy:
+    def __init__(self, node_ids, parent_ids):
+        node_ids = np.asarray(node_ids)
+        parent_srs = pd.Series(parent_ids)
+        is_root = parent_srs.isna().to_numpy()
+
+        # Nodes are kept in the order of their IDs, so an ID is found with a binary search
+        order = np.argsort(node_ids, kind='stable')
+        self.ids = node_ids[order]
+        if len(self.ids) > 1 and (self.ids[1:] == self.ids[:-1]).any():
+            raise ValueError('Node IDs are not unique')
+
+        num_nodes = len(self.ids)
+        self.parent = np.full(num_nodes, -1, dtype=np.int64)
+        non_root = ~is_root[order]
+        parent_vals = parent_srs.to_numpy()[order][non_root].astype(self.ids.dtype)
+        self.parent[non_root] = self.index_of(parent_vals)
+
+        # Children in CSR form, in the order of their IDs
+        child_nodes = np.flatnonzero(self.parent >= 0)
+        self.child_idx = child_nodes[np.argsort(self.parent[child_nodes], kind='stable')]
+        self.child_ptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        self.child_ptr[1:] = np.cumsum(np.bincount(self.parent[child_nodes], minlength=num_nodes))
+
+        self.levels = self.build_levels()
+        self.depth = np.empty(num_nodes, dtype=np.int64)
+        for level_num, level in enumerate(self.levels):
+            self.depth[level] = level_num
+
+        self.tin, self.tout = self.build_euler_intervals()
+        # Node at each position of the Euler tour
+        self.euler = np.empty(num_nodes, dtype=np.int64)
+        self.euler[self.tin] = np.arange(num_nodes)
+
+    # Get the positions of node IDs. Raises ValueError for an ID that isn't a node
+    def index_of(self, node_ids):
+        node_ids = np.asarray(node_ids)
+        pos = np.searchsorted(self.ids, node_ids)
+        found = (pos < len(self.ids)) & (self.ids[np.minimum(pos, len(self.ids) - 1)] == node_ids)
+
+        if not found.all():
+            raise ValueError(f'Unknown node IDs: {np.unique(node_ids[~found])[:10].tolist()}')
+
+        return pos
+
+    # Get the IDs of the nodes at positions as a pandas array, NA where mask is False. The array keeps the kind of
+    # the IDs, e.g. nullable Int64 for integer IDs and string for string IDs
+    def ids_or_na(self, pos, mask):
+        id_arr = pd.array(self.ids[np.where(mask, pos, 0)] if len(self.ids) else self.ids)
+        id_arr[~mask] = pd.NA
+
+        return id_arr
+
+    # Get the children of a set of nodes, from the CSR arrays without a loop over the nodes
+    def children_of(self, nodes):
+        starts = self.child_ptr[nodes]
+        counts = self.child_ptr[nodes + 1] - starts
+        if counts.sum() == 0:
+            return np.empty(0, dtype=np.int64)
+
+        # Position of each child in child_idx: the start of its parent's run plus its offset within the run
+        run_offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        return self.child_idx[np.repeat(starts, counts) + run_offsets]
+
+    # Group the nodes by level, from the roots down. Nodes not reached from a root are in a cycle
+    def build_levels(self):
+        levels = []
+        frontier = np.flatnonzero(self.parent < 0)
+
+        while len(frontier):
+            levels.append(frontier)
+            frontier = self.children_of(frontier)
+
+        if sum(len(level) for level in levels) != len(self.ids):
+            reached = np.zeros(len(self.ids), dtype=bool)
+            reached[np.concatenate(levels) if levels else []] = True
+            raise ValueError(f'Hierarchy has a cycle through nodes {self.ids[~reached][:10].tolist()}')
+
+        return levels
+
+    # Number the nodes in pre-order (tin) and get the last number in the subtree of each (tout). Subtree sizes are
+    # summed from the deepest level up, then each level is numbered from its parents' numbers: a child comes
+    # right after its parent and the subtrees of its older siblings
+    def build_euler_intervals(self):
+        num_nodes = len(self.ids)
+        size = np.ones(num_nodes, dtype=np.int64)
+        for level in reversed(self.levels[1:]):
+            np.add.at(size, self.parent[level], size[level])
+
+        # Offset of each child from its parent's number: 1 plus the sizes of its older siblings
+        child_sizes = np.concatenate([[0], np.cumsum(size[self.child_idx])])
+        sibling_start = self.child_ptr[self.parent[self.child_idx]]
+        offset = np.empty(num_nodes, dtype=np.int64)
+        offset[self.child_idx] = 1 + child_sizes[:-1] - child_sizes[sibling_start]
+
+        tin = np.empty(num_nodes, dtype=np.int64)
+        roots = self.levels[0] if self.levels else np.empty(0, dtype=np.int64)
+        tin[roots] = np.cumsum(size[roots]) - size[roots]
+        for level in self.levels[1:]:
+            tin[level] = tin[self.parent[level]] + offset[level]
+
+        return tin, tin + size - 1
+
+    # Get the IDs of a node and all the nodes under it, in pre-order
+    def subtree(self, node_id):
+        node = self.index_of([node_id])[0]
+
+        return self.ids[self.euler[self.tin[node]:self.tout[node] + 1]]
+
+    # Check for each pair whether descendant_ids is in the subtree of ancestor_ids (a node is in its own subtree)
+    def is_descendant(self, descendant_ids, ancestor_ids):
+        desc = self.index_of(descendant_ids)
+        anc = self.index_of(ancestor_ids)
+
+        return (self.tin[anc] <= self.tin[desc]) & (self.tin[desc] <= self.tout[anc])
+
+    # Get the depths of nodes. Roots are at depth 0
+    def depths(self, node_ids):
+        return self.depth[self.index_of(node_ids)]
+
+    # Get the path from a node up to its root, as IDs
+    def ancestor_path(self, node_id):
+        node = self.index_of([node_id])[0]
+
+        path = [node]
+        while self.parent[path[-1]] >= 0:
+            path.append(self.parent[path[-1]])
+
+        return self.ids[path]
+
+    # Get the ancestor of each node at a depth, NA where a node is above that depth. All the nodes step up
+    # together, once per level
+    def ancestors_at_depth(self, node_ids, at_depth):
+        nodes = self.index_of(node_ids)
+        anc = nodes.copy()
+
+        for _ in range(max(int(self.depth[nodes].max(initial=0)) - at_depth, 0)):
+            step = self.depth[anc] > at_depth
+            anc[step] = self.parent[anc[step]]
+
+        return self.ids_or_na(anc, self.depth[nodes] >= at_depth)
+
+    # Materialize the closure table: one row per ancestor and descendant pair, with the distance between them.
+    # Every node is paired with itself at distance 0. Built with one vectorized step per level: each node's
+    # ancestor at distance d + 1 is the parent of its ancestor at distance d.
+    # Column names are upper case so that Snowflake, which upper cases unquoted names, matches them in queries
+    def closure_table(self):
+        desc = np.arange(len(self.ids))
+        anc = desc.copy()
+        dist = 0
+        pair_parts = []
+
+        while len(desc):
+            pair_parts.append((anc, desc, np.full(len(desc), dist, dtype=np.int64)))
+            has_parent = self.parent[anc] >= 0
+            desc = desc[has_parent]
+            anc = self.parent[anc[has_parent]]
+            dist += 1
+
+        if not pair_parts:
+            return pd.DataFrame({'ANCESTOR_ID': self.ids, 'DESCENDANT_ID': self.ids,
+                                 'DISTANCE': np.empty(0, dtype=np.int64)})
+
+        anc, desc, dist = (np.concatenate(cols) for cols in zip(*pair_parts))
+
+        return pd.DataFrame({'ANCESTOR_ID': self.ids[anc], 'DESCENDANT_ID': self.ids[desc], 'DISTANCE': dist})
+
+    # Get the nodes with their parent, depth and Euler interval. Loaded to the warehouse, a subtree query becomes a
+    # range condition on TIN
+    def node_table(self):
+        return pd.DataFrame({'NODE_ID': self.ids, 'PARENT_ID': self.ids_or_na(self.parent, self.parent >= 0),
+                             'DEPTH': self.depth, 'TIN': self.tin, 'TOUT': self.tout})
+
+
+# Load a dataframe to a Snowflake table with the fast loader: chunks encoded in parallel, PUT to the table stage
+# and loaded with one COPY INTO. Returns the number of rows loaded
+def save_table(conn, dfm, tbl_nm, pl_siz, stage_fmt='csv', codec=None, load_threads=None):
+    fss.create_table(conn, dfm, tbl_nm)
+
+    stage_fmt, codec = resolve_stage_format(dfm, stage_fmt, codec)
+    stage_path, uploaded = fss.write_df_to_stage_parallel(conn, dfm, '%' + tbl_nm, tbl_nm.lower(), pl_siz,
+                                                          stage_fmt=stage_fmt, codec=codec, load_threads=load_threads)
+    if not uploaded:
+        return 0
+
+    rows_loaded = fss.load_data_to_snowflake(conn, tbl_nm, stage_path, uploaded, stage_fmt=stage_fmt, codec=codec)
+    conn.commit()
+
+    return rows_loaded
+
+
+if __name__ == "__main__":
+    # The sample dataset is in the data folder of this repository
+    file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'employee_dataset.csv')
+    closure_table_name = 'employee_closure'
+    node_table_name = 'employee_node'
+    pool_size = 4
+    offline = True  # Use the local stand-in for the stage and the database instead of Snowflake
+    load_threads = 8 if offline else None  # Files the warehouse loads at once. From the warehouse size if None
+    start_time = datetime.now()
+
+    configure_metrics()
+
+    with timed_stage('build_hierarchy'):
+        emp_df = read_employee_edges(file_path)
+        hierarchy = Hierarchy(emp_df['employee_id'], emp_df['supervisor_employee_id'])
+
+    print('Subtree of employee 2:', hierarchy.subtree(2).tolist())
+    print('Path from employee 12 to the top:', hierarchy.ancestor_path(12).tolist())
+    print('Depths:', dict(zip(hierarchy.ids.tolist(), hierarchy.depth.tolist())))
+
+    with timed_stage('closure_table') as closure_fields:
+        closure_df = hierarchy.closure_table()
+        closure_fields['rows'] = len(closure_df)
+
+    conn = None
+    try:
+        if offline:
+            conn = fss.LocalStageConn(os.path.join('/tmp', 'local_stage'), os.path.join('/tmp', 'local_stage.db'))
+        else:
+            conn, _ = create_conn(warehouse='<Warehouse>', database='<Database>', schema='<Schema>')
+
+        with timed_stage('load', table=closure_table_name) as load_fields:
+            load_fields['rows_loaded'] = save_table(conn, closure_df, closure_table_name, pool_size,
+                                                    load_threads=load_threads)
+        with timed_stage('load', table=node_table_name) as load_fields:
+            load_fields['rows_loaded'] = save_table(conn, hierarchy.node_table(), node_table_name, pool_size,
+                                                    load_threads=load_threads)
+    finally:
+        if conn is not None:
+            conn.close()
+
+    print(f'Time to build and load hierarchy: {datetime.now() - start_time}')
+
+    exit(0)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+"""job_executor.py: Run scheduled jobs on a bounded pool with concurrency limits, overlap policy and timeouts."""
+
+"""
+Starting a new thread for every trigger puts no bound on the number of jobs running at once. A burst of triggers,
+e.g. from run_all_immediately, or a job that hangs and is triggered again, can pile up threads without limit.
+
+JobExecutor runs jobs on a fixed number of worker threads:
+- At most max_workers jobs run at once in total, and at most max_concurrent runs of each job
+- A trigger of a job that is already running its max_concurrent runs is handled by the job's overlap policy.
+  'skip' drops the trigger, 'queue' runs it when a run of the job ends and 'replace' keeps only the latest trigger
+  waiting, dropping any queued before it
+- No more than max_queued triggers wait at once. Triggers beyond that are rejected, so a scheduler that triggers
+  faster than the jobs run doesn't build up an unbounded backlog
+- A job can have a timeout. Jobs run in 'process' mode run in a child process, which is terminated when it runs
+  over its timeout. A thread can't be stopped, so a job in 'thread' mode that runs over its timeout is reported
+  and keeps its slot until it ends. Run CPU bound jobs, or jobs that may hang, in process mode
+- Every run, and every trigger that is skipped, rejected or dropped, is passed to an on_done hook, e.g. to record
+  the history of job runs (job_history.py)
+
+Used by python_scheduling.py.
+"""
+
+import collections
+import multiprocessing
+import threading
+import time
+import traceback
+
+__author__ = "Arindam Sinha"
+__license__ = "GPL"
+__version__ = "1.0.0"
+__status__ = "Prototype"
+
+OVERLAP_POLICIES = ('skip', 'queue', 'replace')
+RUN_MODES = ('thread', 'process')
+
+# Settings of a job that hasn't been configured
+DEFAULT_JOB_SETTINGS = {'max_concurrent': 1, 'overlap': 'skip', 'timeout': None, 'mode': 'thread'}
+
+
+# Runs jobs on a fixed number of worker threads, with limits on the runs of each job
+class JobExecutor:
+    def __init__(self, max_workers=8, max_queued=100, on_done=None):
+        self.max_queued = max_queued
+        self.on_done = on_done
+        self.job_settings = {}
+        # Runs of each job that are running or ready to run
+        self.claimed = collections.Counter()
+        # Triggers of each job waiting for a run of the job to end
+        self.waiting = collections.defaultdict(collections.deque)
+        # Triggers that run as soon as a worker is free
+        self.ready = collections.deque()
+        self.counts = collections.Counter()
+        self.cond = threading.Condition()
+        self.stopping = False
+
+        self.workers = [threading.Thread(target=self.work, name=f'job-worker-{worker_num}', daemon=True)
+                        for worker_num in range(max_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    # Set the concurrency limit, overlap policy, timeout (in seconds) and run mode of a job. Settings not given keep
+    # their defaults
+    def configure_job(self, job_nm, max_concurrent=None, overlap=None, timeout=None, mode=None):
+        settings = dict(DEFAULT_JOB_SETTINGS)
+        settings.update({k: v for k, v in {'max_concurrent': max_concurrent, 'overlap': overlap, 'timeout': timeout,
+                                           'mode': mode}.items() if v is not None})
+
+        if settings['overlap'] not in OVERLAP_POLICIES:
+            raise ValueError(f"Unknown overlap policy '{settings['overlap']}' for job {job_nm}. "
+                             f"Use one of {OVERLAP_POLICIES}")
+        if settings['mode'] not in RUN_MODES:
+            raise ValueError(f"Unknown mode '{settings['mode']}' for job {job_nm}. Use one of {RUN_MODES}")
+
+        with self.cond:
+            self.job_settings[job_nm] = settings
+
+    def settings_of(self, job_nm):
+        return self.job_settings.get(job_nm, DEFAULT_JOB_SETTINGS)
+
+    # Pass a run, or a trigger that didn't run with its outcome, to the on_done hook. An error in the hook is
+    # printed and doesn't stop the worker
+    def report(self, run, outcome, error=None):
+        if self.on_done is None:
+            return
+
+        now = time.time()
+        run = dict(run, outcome=outcome, error=error)
+        run.setdefault('start_ts', now)
+        run.setdefault('end_ts', now)
+
+        try:
+            self.on_done(run)
+        except Exception:
+            traceback.print_exc()
+
+    # Submit a run of a job. trigger is what caused it, e.g. 'scheduled' or 'manual', and due_ts the time (epoch
+    # seconds) it was due, for scheduled runs. Returns what happened to the trigger: 'accepted' (runs as soon as a
+    # worker is free), 'queued', 'replaced' (queued in place of the triggers waiting before it), 'skipped' or
+    # 'rejected'
+    def submit(self, job_nm, job, args=(), trigger='manual', due_ts=None):
+        settings = self.settings_of(job_nm)
+        item = ({'job_nm': job_nm, 'trigger': trigger, 'due_ts': due_ts}, job, args)
+        dropped = []
+
+        reason = None
+
+        with self.cond:
+            if self.stopping:
+                status = 'rejected'
+                reason = 'executor is shutting down'
+            elif len(self.ready) + sum(len(trigs) for trigs in self.waiting.values()) >= self.max_queued:
+                status = 'rejected'
+                reason = f'queue full (max_queued={self.max_queued})'
+            elif self.claimed[job_nm] < settings['max_concurrent']:
+                self.claimed[job_nm] += 1
+                self.ready.append(item)
+                self.cond.notify()
+                status = 'accepted'
+            elif settings['overlap'] == 'queue':
+                self.waiting[job_nm].append(item)
+                status = 'queued'
+            elif settings['overlap'] == 'replace':
+                dropped = list(self.waiting[job_nm])
+                self.waiting[job_nm].clear()
+                self.waiting[job_nm].append(item)
+                status = 'replaced'
+            else:
+                status = 'skipped'
+                reason = f'overlap policy, {self.claimed[job_nm]} run(s) of it already running or ready'
+
+            self.counts[status] += 1
+
+        if reason is not None:
+            print(f'Run of job {job_nm} {status}: {reason}')
+            self.report(item[0], status, reason)
+        for run, _, _ in dropped:
+            self.report(run, 'dropped')
+
+        return status
+
+    # Worker thread. Takes the next ready trigger and runs it, then makes ready the next trigger of the same job
+    def work(self):
+        while True:
+            with self.cond:
+                while not self.ready and not self.stopping:
+                    self.cond.wait()
+                if not self.ready:
+                    return
+                run, job, args = self.ready.popleft()
+
+            job_nm = run['job_nm']
+            start_ts = time.time()
+            outcome, error = self.run_job(job_nm, job, args)
+            self.report(dict(run, start_ts=start_ts, end_ts=time.time()), outcome, error)
+
+            with self.cond:
+                self.counts[outcome] += 1
+                self.claimed[job_nm] -= 1
+                if self.waiting[job_nm] and not self.stopping:
+                    self.claimed[job_nm] += 1
+                    self.ready.append(self.waiting[job_nm].popleft())
+                    self.cond.notify()
+
+    # Run one job in this worker thread, or in a child process in process mode. Returns the outcome ('ok',
+    # 'failed' or 'timed_out') and the error if it failed
+    def run_job(self, job_nm, job, args):
+        settings = self.settings_of(job_nm)
+        timeout = settings['timeout']
+
+        if settings['mode'] == 'process':
+            # An exception in the job prints its traceback in the child and sets a non-zero exit code
+            job_proc = multiprocessing.Process(target=job, args=args, name=job_nm, daemon=True)
+            job_proc.start()
+            job_proc.join(timeout)
+
+            if job_proc.is_alive():
+                print(f'Job {job_nm} ran over its timeout of {timeout}s and was terminated')
+                job_proc.terminate()
+                job_proc.join()
+                return 'timed_out', f'Terminated after {timeout}s'
+
+            if job_proc.exitcode != 0:
+                return 'failed', f'Exit code {job_proc.exitcode}'
+
+            return 'ok', None
+
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, print, args=(f'Job {job_nm} has run over its timeout of {timeout}s',))
+            timer.daemon = True
+            timer.start()
+
+        run_start = time.monotonic()
+        error = None
+        try:
+            job(*args)
+            outcome = 'ok'
+        except Exception as ex:
+            # Print the error and carry on. A failed job doesn't stop the worker or the scheduler
+            traceback.print_exc()
+            outcome = 'failed'
+            error = repr(ex)
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+        if outcome == 'ok' and timeout is not None and time.monotonic() - run_start > timeout:
+            outcome = 'timed_out'
+            error = f'Ran for over {timeout}s'
+
+        return outcome, error
+
+    # Number of triggers accepted, queued, replaced, skipped and rejected, and of runs by outcome
+    def stats(self):
+        with self.cond:
+            return dict(self.counts)
+
+    # Stop taking triggers and drop the ones waiting. With wait, also wait for the running jobs to end
+    def shutdown(self, wait=True):
+        with self.cond:
+            self.stopping = True
+            dropped = list(self.ready) + [item for trigs in self.waiting.values() for item in trigs]
+            for run, _, _ in self.ready:
+                self.claimed[run['job_nm']] -= 1
+            self.ready.clear()
+            self.waiting.clear()
+            self.cond.notify_all()
+
+        for run, _, _ in dropped:
+            self.report(run, 'dropped')
+
+        if wait:
+            for worker in self.workers:
+                worker.join()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+"""job_history.py: Record the history of job runs in SQLite and report latency, lateness and failure rates."""
+
+"""
+A scheduler without a history of job runs can't tell that a job is slowly taking longer until it overruns its
+window. JobHistory records every run of every job in a SQLite database: the job, what triggered it (scheduled,
+manual or run_all), when it was due, when it started and ended, how long it took, its outcome and its error.
+Triggers that never ran (skipped, rejected or dropped by the executor) are recorded too, as missed runs.
+
+Run as a script it reports per job, for the last number of days:
+- Runs, failures and the failure rate
+- p50 and p95 run durations, and the change in p50 from the same number of days before, to find jobs that are
+  slowly getting slower
+- Late runs, that started more than late_secs after they were due, and missed runs
+
+e.g. python job_history.py /tmp/job_history.db --days 7 --late-secs 60
+
+Used by python_scheduling.py.
+"""
+
+import argparse
+import sqlite3
+import threading
+import time
+
+__author__ = "Arindam Sinha"
+__license__ = "GPL"
+__version__ = "1.0.0"
+__status__ = "Prototype"
+
+# Outcomes of triggers that never ran
+MISSED_OUTCOMES = ('skipped', 'rejected', 'dropped')
+
+CREATE_RUNS_TABLE = """\
+CREATE TABLE IF NOT EXISTS job_runs (
+    run_id INTEGER PRIMARY KEY,
+    job_nm TEXT NOT NULL,
+    trigger TEXT NOT NULL,
+    due_ts REAL,
+    start_ts REAL NOT NULL,
+    end_ts REAL NOT NULL,
+    duration_secs REAL NOT NULL,
+    outcome TEXT NOT NULL,
+    error TEXT
+)"""
+CREATE_RUNS_INDEX = "CREATE INDEX IF NOT EXISTS job_runs_job_start ON job_runs (job_nm, start_ts)"
+
+
+# Get a percentile of a list of values
+def percentile(vals, pct):
+    if not vals:
+        return None
+
+    vals = sorted(vals)
+
+    return vals[min(int(len(vals) * pct / 100), len(vals) - 1)]
+
+
+# History of job runs in a SQLite database. Safe to record from several threads
+class JobHistory:
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+        with self.lock, self.db:
+            # WAL lets the report read while the scheduler writes
+            self.db.execute("PRAGMA journal_mode = WAL")
+            self.db.execute(CREATE_RUNS_TABLE)
+            self.db.execute(CREATE_RUNS_INDEX)
+
+    # Record a run, a dictionary with job_nm, trigger, due_ts, start_ts, end_ts, outcome and error. Used as the
+    # on_done hook of the job executor
+    def record(self, run):
+        with self.lock, self.db:
+            self.db.execute("INSERT INTO job_runs (job_nm, trigger, due_ts, start_ts, end_ts, duration_secs, outcome, "
+                            "error) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (run['job_nm'], run['trigger'], run.get('due_ts'), run['start_ts'], run['end_ts'],
+                             run['end_ts'] - run['start_ts'], run['outcome'], run.get('error')))
+
+    # Get the runs that started from since_ts and before until_ts, as (job_nm, due_ts, start_ts, duration_secs,
+    # outcome)
+    def runs_between(self, since_ts, until_ts):
+        with self.lock:
+            return self.db.execute("SELECT job_nm, due_ts, start_ts, duration_secs, outcome FROM job_runs "
+                                   "WHERE start_ts >= ? AND start_ts < ?", (since_ts, until_ts)).fetchall()
+
+    # Report per job on the last days days: runs, failures, failure rate, p50 and p95 duration, the change in p50
+    # from the days before, and late and missed runs. Returns a list of dictionaries, one per job
+    def report(self, days=7, late_secs=60):
+        now = time.time()
+        window_secs = days * 86400
+        prev_durations = {}
+        for job_nm, _, _, duration_secs, outcome in self.runs_between(now - 2 * window_secs, now - window_secs):
+            if outcome not in MISSED_OUTCOMES:
+                prev_durations.setdefault(job_nm, []).append(duration_secs)
+
+        job_runs = {}
+        for job_nm, due_ts, start_ts, duration_secs, outcome in self.runs_between(now - window_secs, now):
+            job_runs.setdefault(job_nm, []).append((due_ts, start_ts, duration_secs, outcome))
+
+        job_reports = []
+        for job_nm, runs in sorted(job_runs.items()):
+            ran = [run for run in runs if run[3] not in MISSED_OUTCOMES]
+            durations = [run[2] for run in ran]
+            failed = sum(1 for run in ran if run[3] != 'ok')
+            p50_secs = percentile(durations, 50)
+            prev_p50_secs = percentile(prev_durations.get(job_nm, []), 50)
+
+            job_reports.append({
+                'job': job_nm, 'runs': len(ran), 'failed': failed,
+                'failure_rate': round(failed / len(ran), 3) if ran else None,
+                'p50_secs': p50_secs, 'p95_secs': percentile(durations, 95),
+                'p50_change': round(p50_secs / prev_p50_secs, 2) if p50_secs and prev_p50_secs else None,
+                'late': sum(1 for run in ran if run[0] is not None and run[1] - run[0] > late_secs),
+                'max_late_secs': max((run[1] - run[0] for run in ran if run[0] is not None), default=None),
+                'missed': len(runs) - len(ran)})
+
+        return job_reports
+
+    def close(self):
+        self.db.close()
+
+
+# Print the report as a table
+def print_report(job_reports):
+    if not job_reports:
+        print('No job runs in the period')
+        return
+
+    cols = list(job_reports[0])
+    rows = [[str(round(job_report[col], 3) if isinstance(job_report[col], float) else job_report[col])
+             for col in cols] for job_report in job_reports]
+    widths = [max(len(col), *(len(row[col_num]) for row in rows)) for col_num, col in enumerate(cols)]
+
+    print('  '.join(col.ljust(width) for col, width in zip(cols, widths)).rstrip())
+    for row in rows:
+        print('  '.join(val.ljust(width) for val, width in zip(row, widths)).rstrip())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Report latency, lateness and failure rates of job runs')
+    parser.add_argument('db_path', help='SQLite database the scheduler records job runs in')
+    parser.add_argument('--days', type=float, default=7, help='Days to report on. Default 7')
+    parser.add_argument('--late-secs', type=float, default=60,
+                        help='Seconds after it was due a run counts as late. Default 60')
+    cli_args = parser.parse_args()
+
+    history = JobHistory(cli_args.db_path)
+    try:
+        print_report(history.report(cli_args.days, cli_args.late_secs))
+    finally:
+        history.close()
+
+    exit(0)
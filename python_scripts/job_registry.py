@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+"""job_registry.py: Register scheduler jobs once and bind them to their arguments, without eval."""
+
+"""
+Looking a job up with eval on the name in the config file runs arbitrary code from the config, only finds
+functions in the scheduler's own module, and redoes the lookup and the argument parsing every time the schedule
+is built. Jobs are registered once instead:
+- With the @job decorator on the function, under its name or a name given, e.g. @job or @job('nightly_load')
+- As a 'module:function' target, e.g. register_lazy('nightly_load', 'etl_jobs:nightly_load'), or from the
+  'python_scheduling.jobs' entry point group of installed packages (discover_entry_points, called once when the
+  scheduler starts). The module is only imported the first time the job runs, so jobs in other modules don't slow
+  down the start of the scheduler
+- A job in the config file can name its function as 'module:function' with a function key
+
+bind_job resolves a job and binds it to its arguments from the config. The arguments are checked against the
+signature of the function, at bind time for registered functions and on the first run for lazy targets, and the
+binding is cached. A lazy target is resolved by the scheduler process, on its first trigger, so a job run in a
+child process gets the function already resolved. A target that can't be imported raises a ValueError, like any
+other bad job in the config. A config reload only makes new bindings for the jobs that changed.
+
+Used by python_scheduling.py.
+"""
+
+import importlib
+import inspect
+import threading
+
+from importlib.metadata import entry_points
+
+__author__ = "Arindam Sinha"
+__license__ = "GPL"
+__version__ = "1.0.0"
+__status__ = "Prototype"
+
+ENTRY_POINT_GROUP = 'python_scheduling.jobs'
+
+# Function, or 'module:function' target not yet imported, of each job name
+_registry = {}
+# Functions of the 'module:function' targets imported so far
+_resolved = {}
+# Bindings by job name, target and arguments
+_bindings = {}
+_registry_lock = threading.Lock()
+
+
+# Decorator registering a function as a job, under its own name or the name given
+def job(job_nm=None):
+    def register(func):
+        _registry[job_nm or func.__name__] = func
+        return func
+
+    # Used bare as @job
+    if callable(job_nm):
+        func, job_nm = job_nm, None
+        return register(func)
+
+    return register
+
+
+# Register a job as a 'module:function' target, imported the first time the job runs
+def register_lazy(job_nm, target):
+    if ':' not in target:
+        raise ValueError(f"Invalid target '{target}' for job {job_nm}. Use 'module:function'")
+
+    _registry[job_nm] = target
+
+
+# Register lazily the jobs of the entry point group of installed packages. Returns the names registered
+def discover_entry_points(group=ENTRY_POINT_GROUP):
+    job_nms = []
+    for entry_point in entry_points(group=group):
+        register_lazy(entry_point.name, entry_point.value)
+        job_nms.append(entry_point.name)
+
+    return job_nms
+
+
+# Get the function of a 'module:function' target, importing the module the first time. A module or function that
+# isn't found raises a ValueError
+def resolve_target(target):
+    with _registry_lock:
+        if target not in _resolved:
+            mod_nm, _, func_nm = target.partition(':')
+            try:
+                func = getattr(importlib.import_module(mod_nm), func_nm)
+            except (ImportError, AttributeError) as ex:
+                raise ValueError(f"Target '{target}' can't be imported: {ex}")
+            if not callable(func):
+                raise TypeError(f"Target '{target}' is not callable")
+            _resolved[target] = func
+
+        return _resolved[target]
+
+
+# A job bound to its arguments. Calling it runs the job
+class JobBinding:
+    def __init__(self, job_nm, target, args):
+        self.job_nm = job_nm
+        self.target = target
+        self.args = args
+        self.func = None
+
+        # Registered functions are checked now. Lazy targets are checked on the first run, when they are imported
+        if callable(target):
+            self.resolve()
+
+    # Get the function of the job, importing it for a lazy target, and check that it takes the arguments it is
+    # bound to. The function is kept, so this is only done once
+    def resolve(self):
+        if self.func is None:
+            func = self.target if callable(self.target) else resolve_target(self.target)
+
+            try:
+                inspect.signature(func).bind(*self.args)
+            except TypeError as ex:
+                raise TypeError(f'Arguments {self.args} of job {self.job_nm} don\'t match its function: {ex}')
+
+            self.func = func
+
+        return self.func
+
+    def __call__(self):
+        return self.resolve()(*self.args)
+
+
+# Bind a job to its arguments. target is a 'module:function' to run instead of the job registered under the name.
+# The same job, target and arguments get the same binding
+def bind_job(job_nm, args, target=None):
+    if target is None:
+        if job_nm not in _registry:
+            raise KeyError(f"No job registered as '{job_nm}'")
+        target = _registry[job_nm]
+    elif ':' not in target:
+        raise ValueError(f"Invalid target '{target}' for job {job_nm}. Use 'module:function'")
+
+    key = (job_nm, target, args)
+    with _registry_lock:
+        binding = _bindings.get(key)
+
+    if binding is None:
+        binding = JobBinding(job_nm, target, args)
+        with _registry_lock:
+            _bindings[key] = binding
+
+    return binding
+
+
+# Drop the cached bindings of a job, e.g. when it is removed from the config
+def unbind_job(job_nm):
+    with _registry_lock:
+        for key in [key for key in _bindings if key[0] == job_nm]:
+            del _bindings[key]
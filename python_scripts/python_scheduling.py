@@ -11,17 +11,30 @@ for the time being.
 This demonstrates a number of Python features I used:
 - Execution of jobs from a continuously running scheduler (should be run in background)
   - Config file driven - allows dynamically changing parameters that may need changing without stopping the scheduler
+  - The config file is only re-read when its modification time changes, and only the jobs added, removed or changed
+    in it are re-registered, so the other jobs keep their schedule
+  - Event driven (sched_core.py): the scheduler sleeps exactly until the next job is due, and is woken at once by
+    control commands on a local Unix socket or by signals, e.g. python python_scheduling.py run job_a to rerun a job.
+    SIGHUP reloads the config and SIGTERM stops the scheduler. The config file is never written by the scheduler
   - Threaded execution to ensure scheduler does not error out if any of the jobs fail
+  - Jobs run on a bounded pool (job_executor.py) with a global and a per-job limit on concurrent runs, a policy for
+    a trigger of a job that is still running (skip, queue or replace), timeouts and a process mode for CPU bound jobs
   - Passing parameters to threaded jobs and scheduled jobs
 - Sending HTML alert emails. For this example I have used Gmail using an app password that has to be set up separately
   - See https://support.google.com/accounts/answer/185833?hl=en for setting up app password
   - In a corporate setting a password usually won't be required
+  - Emails are queued and sent in batches from a background thread over one reused SMTP session (email_outbox.py),
+    with retries and delivery latency stats, so jobs don't wait for the mail server
 - Usage of AWS Secrets Manager to retrieve app password instead of putting it in config file. In a corporate
   environment, this could be for database credentials etc.
-- Practical use of Python eval to read in a function name from config file and execute that function
-
-Python scheduling is not meant to replace an actual scheduler as it lacks functionality like
-history of job runs etc., but for an intermediate period it is more than adequate, especially if properly parameterized.
+- A job registry (job_registry.py) to find the function of each job named in the config file, without eval. Jobs
+  are registered with the @job decorator, or as 'module:function' targets (also from package entry points)
+  imported the first time they run, and bound once to their arguments, which are checked against the function's
+  signature
+
+Python scheduling is not meant to replace an actual scheduler, but for an intermediate period it is more than adequate,
+especially if properly parameterized. Every run of every job is recorded in a SQLite database (job_history.py), which
+reports per job p50 and p95 durations, late and missed runs and failure rates.
 This script demonstrates the principle by sending HTML emails rather than doing any actual database activity which
 would typically be what would need to be done in Production.
 
@@ -35,19 +48,17 @@ Sample config file sched_config.yml in https://github.com/arindamsinha12/scripts
 this example.
 """
 
-import schedule
-import threading
+import os
+import sys
 import yaml
-import smtplib
-import email
-import json
-import boto3
-import smtplib
 
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from botocore.exceptions import ClientError
-from time import sleep
+from email_outbox import EmailOutbox, build_message, open_smtp
+from functools import partial
+from job_executor import JobExecutor
+from job_history import JobHistory
+from job_registry import job, bind_job, unbind_job, discover_entry_points
+from sched_core import TimerHeap, ControlChannel, send_control
+from secrets_cache import get_secret
 
 __author__ = "Arindam Sinha"
 __license__ = "GPL"
@@ -55,53 +66,35 @@ __version__ = "1.0.0"
 __status__ = "Prototype"
 
 
-# Send an HTML email
-def send_email(eml_sndr, eml_rcvrs, password, subject, message_body):
-    port = 587
-    smtp_server = "smtp.gmail.com"
+# Outbox the alert emails are queued on. Set up by the scheduler. Emails are sent directly if None
+email_outbox = None
 
-    message = MIMEMultipart("alternative")
-    message["Subject"] = subject
-    message["From"] = eml_sndr
-    message["To"] = eml_rcvrs
 
-    body = MIMEText(message_body, "html")
-    message.attach(body)
+# Send an HTML email. Queued on the outbox, which sends it in the background over one reused SMTP session, so the
+# job doesn't wait for the connection, the TLS handshake, the login or the mail server
+def send_email(eml_sndr, eml_rcvrs, password, subject, message_body):
+    if email_outbox is not None:
+        email_outbox.send(eml_rcvrs, subject, message_body)
+        return
 
-    server = smtplib.SMTP(smtp_server, 587)
-    server.connect(smtp_server, 587)
-    server.ehlo()
-    server.starttls()
-    server.ehlo()
-    server.login(eml_sndr, password)
-    text = message.as_string()
-    server.sendmail(eml_sndr, eml_rcvrs, text)
-    server.quit()
+    server = open_smtp("smtp.gmail.com", 587, eml_sndr, password)
+    try:
+        server.send_message(build_message(eml_sndr, eml_rcvrs, subject, message_body))
+    finally:
+        server.quit()
 
 
-# Retrieve any credentials for AWS Secrets Manager. Any Secret Management utility can be used
+# Retrieve any credentials for AWS Secrets Manager. Any Secret Management utility can be used.
+# Served from the cache shared with the other scripts, so repeated calls don't go back to Secrets Manager
 def get_email_password(secret_name):
     region_name = "us-west-2"
 
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
-
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name
-        )
-    except ClientError as e:
-        raise e
-
-    # Convert the response string to a dictionary and return just the password value
-    return json.loads(get_secret_value_response['SecretString'])['password']
+    # Return just the password value from the secret
+    return get_secret(secret_name, region_name)['password']
 
 
 # Job to be run. This is where the main functionality should reside.
+@job
 def job_a(fnm, lnm, eml_sndr, eml_rcvrs, password):
     print(f'Hi, {fnm} {lnm}, Job A running...')
 
@@ -121,6 +114,7 @@ def job_a(fnm, lnm, eml_sndr, eml_rcvrs, password):
 
 
 # Another job to be run
+@job
 def job_b(fnm, lnm, eml_sndr, eml_rcvrs, password):
     print(f'Hi, {fnm} {lnm}, Job B running...')
 
@@ -139,97 +133,190 @@ def job_b(fnm, lnm, eml_sndr, eml_rcvrs, password):
     send_email(eml_sndr, eml_rcvrs, password, subject, email_body)
 
 
-# Run jobs threaded, with arguments passed. Protects the scheduler process for error on failure of a job
-def run_thrd(job, args):
-    job_thread = threading.Thread(target=job, args=args)
-    job_thread.start()
+# Get the modification time and size of the config file. The file is only re-read when these change
+def config_stamp(cfg_path):
+    cfg_stat = os.stat(cfg_path)
+
+    return cfg_stat.st_mtime_ns, cfg_stat.st_size
+
+
+# Read the config file
+def read_config(cfg_path):
+    with open(cfg_path, 'r') as file:
+        return yaml.safe_load(file)
+
+
+# Settings of a job its timer is built from
+def job_settings(job_cfg):
+    return tuple(job_cfg.get(key) for key in ('run_time', 'arguments', 'email_receivers', 'function', 'max_concurrent',
+                                              'overlap', 'timeout', 'mode'))
+
+
+# Compare the jobs of two configs. Returns the names of the jobs added, removed and changed
+def diff_jobs(old_cfg, new_cfg):
+    old_jobs = {k: job_settings(v) for (k, v) in old_cfg.items() if k != 'common'}
+    new_jobs = {k: job_settings(v) for (k, v) in new_cfg.items() if k != 'common'}
+
+    added = new_jobs.keys() - old_jobs.keys()
+    removed = old_jobs.keys() - new_jobs.keys()
+    changed = {k for k in new_jobs.keys() & old_jobs.keys() if new_jobs[k] != old_jobs[k]}
+
+    return added, removed, changed
+
+
+# Get the arguments a job is called with from its config
+def job_args(job_cfg, eml_sndr, eml_pwd):
+    return tuple(job_cfg['arguments'].split(',')) + (eml_sndr, job_cfg['email_receivers'], eml_pwd)
+
+
+# Submit a run of a bound job to the executor. A lazy target is imported and checked here, in the scheduler
+# process, the first time the job runs, so a job run in a child process gets its function already resolved. A
+# target that can't be imported or called with the job's arguments is reported and the run is left out
+def submit_job(executor, job_nm, binding, trigger='manual', due_ts=None):
+    try:
+        func = binding.resolve()
+    except (TypeError, ValueError) as ex:
+        print(f'Run of job {job_nm} not started: {ex}')
+        return None
+
+    return executor.submit(job_nm, func, binding.args, trigger=trigger, due_ts=due_ts)
+
+
+# Add the daily timer of a job, replacing any it had. Each run is submitted to the executor, which runs it on its
+# pool. Protects the scheduler process for error on failure of a job.
+# The job is found in the job registry, by its name or by the 'module:function' in its function key, and bound
+# to its arguments. New jobs can be easily added to file without stopping the scheduler
+def register_job(job_nm, job_cfg, eml_sndr, eml_pwd, executor, timers):
+    binding = bind_job(job_nm, job_args(job_cfg, eml_sndr, eml_pwd), job_cfg.get('function'))
+
+    executor.configure_job(job_nm, job_cfg.get('max_concurrent'), job_cfg.get('overlap'), job_cfg.get('timeout'),
+                           job_cfg.get('mode'))
+    timers.add(job_nm, job_cfg['run_time'], partial(submit_job, executor, job_nm, binding))
+
+
+# Apply a new config to the timers. Only the jobs added, removed or changed are re-registered, the others keep
+# their next run time and binding. A job that can't be registered, e.g. with a name that isn't registered, a
+# function that can't be imported or arguments its function doesn't take, is left out so the other jobs keep
+# running.
+# Returns the names of the jobs added, removed and changed
+def apply_config(old_cfg, new_cfg, eml_sndr, eml_pwd, executor, timers):
+    added, removed, changed = diff_jobs(old_cfg, new_cfg)
+
+    for job_nm in removed | changed:
+        unbind_job(job_nm)
+    for job_nm in removed:
+        timers.remove(job_nm)
+    for job_nm in added | changed:
+        try:
+            register_job(job_nm, new_cfg[job_nm], eml_sndr, eml_pwd, executor, timers)
+        except (KeyError, TypeError, ValueError, ImportError, AttributeError) as ex:
+            print(f'Job {job_nm} not scheduled: {ex}')
+            timers.remove(job_nm)
+
+    return added, removed, changed
 
 
 if __name__ == "__main__":
 
     yaml_file_path = '/tmp/sched_config.yml'  # Your YAML config file
-    prev_run_time = {}
-    init_run = True
+    control_sock_path = '/tmp/python_scheduling.sock'  # Unix socket the scheduler takes control commands on
+
+    # With arguments, send them as a control command to the running scheduler and exit, e.g.
+    # python python_scheduling.py run job_a, or stop, run_all, reload
+    if len(sys.argv) > 1:
+        print(send_control(control_sock_path, ' '.join(sys.argv[1:])))
+        exit(0)
+
+    sched_config = {}
+    cfg_stamp = None
 
-    email_sender = email_receivers = email_password = None
+    job_executor = control = history = None
+    timers = TimerHeap()
     scheduler_stop_flag = False
 
     try:
-        while True:
-            # Read the config file every time the loop runs
-            with open(yaml_file_path, 'r') as file:
-                sched_config = yaml.safe_load(file)
-
-            if init_run:
-                email_password = get_email_password(sched_config['common']['email_secret_name'])
-                email_sender = sched_config['common']['email_sender']
-                init_run = False
-
-            # If stop_scheduler flag is set to true, exit gracefully. This is a continuously running scheduler
-            if sched_config['common']['stop_scheduler']:
-                scheduler_stop_flag = True
-                # Reset the stop_scheduler flag before exiting
-                sched_config['common']['stop_scheduler'] = False
-                with open(yaml_file_path, 'w') as yaml_file:
-                    yaml.dump(sched_config, yaml_file, indent=4, sort_keys=False)
+        sched_config = read_config(yaml_file_path)
+        cfg_stamp = config_stamp(yaml_file_path)
+
+        email_password = get_email_password(sched_config['common']['email_secret_name'])
+        email_sender = sched_config['common']['email_sender']
+        email_outbox = EmailOutbox(sched_config['common'].get('smtp_server', 'smtp.gmail.com'),
+                                   sched_config['common'].get('smtp_port', 587), email_sender, email_password)
+        # Record every run of every job
+        history = JobHistory(sched_config['common'].get('history_db', '/tmp/job_history.db'))
+        job_executor = JobExecutor(sched_config['common'].get('max_concurrent_jobs', 8),
+                                   sched_config['common'].get('max_queued_runs', 100), on_done=history.record)
 
+        control = ControlChannel(control_sock_path)
+        control.handle_signals()
+
+        # Jobs of installed packages, registered before the config names them
+        discover_entry_points()
+        apply_config({}, sched_config, email_sender, email_password, job_executor, timers)
+
+        while True:
+            # Sleep until the next job is due, a control command arrives or it is time to check the config file
+            # for changes. Nothing runs in between
+            next_due_secs = timers.secs_until_next()
+            wait_secs = sched_config['common']['config_check_secs']
+            if next_due_secs is not None:
+                wait_secs = min(wait_secs, next_due_secs)
+
+            reload_config = False
+            for command in control.wait(wait_secs):
+                if command[0] == 'stop':
+                    scheduler_stop_flag = True
+                elif command[0] == 'reload':
+                    reload_config = True
+                elif command[0] == 'run_all':
+                    # Immediately run all scheduled jobs
+                    timers.run_all()
+                else:
+                    # Run individual jobs immediately. Useful for rerunning failed jobs
+                    for job_nm in command[1:]:
+                        if not timers.run_now(job_nm):
+                            print(f'Unknown job {job_nm}, not run')
+
+            # Exit gracefully. This is a continuously running scheduler
+            if scheduler_stop_flag:
                 break
 
-            # If run time for jobs has changed, clear and recreate the schedule. Rerun immediately any job flagged
-            # for rerun
-            run_time_changed = False
-            job_run_immed = False
-            for (k, v) in sched_config.items():
-                # Do this for all jobs. Exclude 'common' as that is for parameters common to all jobs
-                if k != 'common':
-                    if v['run_time'] != prev_run_time.get(k, '99:99'):
-                        run_time_changed = True
-                        prev_run_time[k] = v['run_time']
-
-                    # Run any individual job immediately if flagged. Useful for rerunning failed jobs.
-                    if v['run_immediately']:
-                        email_receivers = v['email_receivers']
-
-                        # Use eval to run the job after reading it from config file. New jobs can be
-                        # easily added to file without stopping the scheduler
-                        run_thrd(eval(k), tuple(v['arguments'].split(',')) +
-                                 (email_sender, email_receivers, email_password))
-                        v['run_immediately'] = False
-                        job_run_immed = True
-
-            # Reset any job specific run_immediately flags
-            if job_run_immed:
-                with open(yaml_file_path, 'w') as yaml_file:
-                    yaml.dump(sched_config, yaml_file, indent=4, sort_keys=False)
-
-            # Recreate schedule if job run time(s) have changed
-            if run_time_changed:
-                schedule.clear()
-                for (k, v) in sched_config.items():
-                    if k != 'common':
-                        email_receivers = v['email_receivers']
-                        schedule.every().day.at(v['run_time']).do(run_thrd,
-                                                                  eval(k), tuple(v['arguments'].split(',')) +
-                                                                  (email_sender, email_receivers, email_password))
-                        prev_run_time[k] = v['run_time']
-
-            # Immediately run all scheduled jobs if flagged, and reset the run_all_immediately flag
-            if sched_config['common']['run_all_immediately']:
-                sched_config['common']['run_all_immediately'] = False
-                with open(yaml_file_path, 'w') as yaml_file:
-                    yaml.dump(sched_config, yaml_file, indent=4, sort_keys=False)
-
-                schedule.run_all()
-
-            # Run any scheduled jobs if the run time for the job has been reached
-            schedule.run_pending()
-
-            # Wait for the configured number of seconds before next loop
-            sleep(sched_config['common']['sleep_duration'])
+            # Read the config file only if it has been modified since it was last read, or a reload was asked for.
+            # Re-register only the jobs that were added, removed or changed
+            new_stamp = config_stamp(yaml_file_path)
+            if reload_config or new_stamp != cfg_stamp:
+                new_config = read_config(yaml_file_path)
+                cfg_stamp = new_stamp
+
+                jobs_added, jobs_removed, jobs_changed = apply_config(sched_config, new_config, email_sender,
+                                                                      email_password, job_executor, timers)
+                if jobs_added or jobs_removed or jobs_changed:
+                    print(f'Config reloaded. Added: {sorted(jobs_added)}, removed: {sorted(jobs_removed)}, '
+                          f'changed: {sorted(jobs_changed)}')
+
+                sched_config = new_config
+
+            # Run any jobs whose run time has been reached
+            timers.run_due()
     except Exception as ex:
         print('Error:', ex)
 
+    if control is not None:
+        control.close()
+
+    # Let the running jobs finish. Triggers still waiting are dropped
+    if job_executor is not None:
+        job_executor.shutdown(wait=True)
+
+    if history is not None:
+        history.close()
+
+    # Send the emails still queued
+    if email_outbox is not None:
+        email_outbox.close()
+        print('Email stats:', email_outbox.stats())
+
     if scheduler_stop_flag:
-        print('Exiting based on stop_scheduler flag.')
+        print('Exiting based on stop command.')
 
     exit(0)
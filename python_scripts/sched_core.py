@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+"""sched_core.py: Timer heap and control channel for an event driven scheduler loop."""
+
+"""
+A scheduler loop that wakes every few seconds to check whether any job is due uses CPU while idle and starts
+jobs up to a whole sleep period late. Taking control flags (stop, run a job now) from the config file means the
+scheduler rewriting a file the user may be editing at the same time.
+
+TimerHeap keeps the next run of every job in a heap, so the loop can sleep exactly until the next job is due.
+ControlChannel takes control commands on a local Unix socket and from signals (SIGHUP reloads, SIGTERM and SIGINT
+stop) and wakes the loop as soon as one arrives:
+- stop: stop the scheduler
+- run <job> [<job> ...]: run jobs now, e.g. to rerun a failed job
+- run_all: run all scheduled jobs now
+- reload: re-read the config file now
+
+send_control sends a command to a running scheduler, e.g. python python_scheduling.py run job_a
+
+Used by python_scheduling.py.
+"""
+
+import datetime as dt
+import heapq
+import itertools
+import os
+import queue
+import selectors
+import signal
+import socket
+import threading
+import time
+
+__author__ = "Arindam Sinha"
+__license__ = "GPL"
+__version__ = "1.0.0"
+__status__ = "Prototype"
+
+CONTROL_COMMANDS = ('stop', 'run', 'run_all', 'reload')
+# Command sent to the loop for each signal
+SIGNAL_COMMANDS = {signal.SIGTERM: 'stop', signal.SIGINT: 'stop'}
+if hasattr(signal, 'SIGHUP'):
+    SIGNAL_COMMANDS[signal.SIGHUP] = 'reload'
+
+
+# Get the time (epoch seconds) of the next daily run at run_time ('HH:MM' or 'HH:MM:SS', local time) after a time
+def next_daily_run(run_time, after=None):
+    if after is None:
+        after = time.time()
+
+    try:
+        run_at = dt.time.fromisoformat(run_time)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid run time '{run_time}'. Use 'HH:MM' or 'HH:MM:SS'")
+
+    next_run = dt.datetime.combine(dt.datetime.fromtimestamp(after).date(), run_at)
+    if next_run.timestamp() <= after:
+        # A day later on the wall clock, which is right across daylight saving changes
+        next_run += dt.timedelta(days=1)
+
+    return next_run.timestamp()
+
+
+# Daily timers of jobs, kept in a heap by next run time. A callback is called with the trigger ('scheduled',
+# 'manual' or 'run_all') and, for scheduled runs, the time it was due. Replacing or removing a timer leaves its
+# old heap entry in place, and it is dropped when it reaches the top
+class TimerHeap:
+    def __init__(self):
+        self.heap = []
+        # Run time, callback and version of the timer of each job. Heap entries of an older version are stale
+        self.timers = {}
+        self.versions = itertools.count()
+
+    # Add the daily timer of a job, replacing any timer it had
+    def add(self, job_nm, run_time, callback):
+        version = next(self.versions)
+        next_run = next_daily_run(run_time)
+
+        self.timers[job_nm] = (run_time, callback, version)
+        heapq.heappush(self.heap, (next_run, version, job_nm))
+
+    def remove(self, job_nm):
+        self.timers.pop(job_nm, None)
+
+    def is_current(self, entry):
+        timer = self.timers.get(entry[2])
+
+        return timer is not None and timer[2] == entry[1]
+
+    # Seconds until the next timer is due, 0 if one is due now, or None if there are no timers
+    def secs_until_next(self):
+        while self.heap and not self.is_current(self.heap[0]):
+            heapq.heappop(self.heap)
+
+        if not self.heap:
+            return None
+
+        return max(self.heap[0][0] - time.time(), 0)
+
+    # Run the callbacks of all the timers that are due, and set each for its next day
+    def run_due(self):
+        now = time.time()
+
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            if not self.is_current(entry):
+                continue
+
+            run_time, callback, version = self.timers[entry[2]]
+            heapq.heappush(self.heap, (next_daily_run(run_time, max(entry[0], now)), version, entry[2]))
+            callback(trigger='scheduled', due_ts=entry[0])
+
+    # Run the callback of a job now, without changing its next run. Returns False if the job has no timer
+    def run_now(self, job_nm, trigger='manual'):
+        if job_nm not in self.timers:
+            return False
+
+        self.timers[job_nm][1](trigger=trigger)
+        return True
+
+    def run_all(self):
+        for job_nm in list(self.timers):
+            self.run_now(job_nm, trigger='run_all')
+
+
+# Takes control commands on a Unix socket and from signals, and wakes the scheduler loop when one arrives.
+# Signal handlers only write to a socket pair, read by the control thread, so they never take a lock the
+# interrupted main thread may hold
+class ControlChannel:
+    def __init__(self, sock_path=None):
+        self.commands = queue.Queue()
+        self.wake = threading.Event()
+        self.sock_path = sock_path
+        self.handled_signals = []
+
+        self.sig_recv, self.sig_send = socket.socketpair()
+        self.sig_send.setblocking(False)
+
+        self.listener = None
+        if sock_path is not None and hasattr(socket, 'AF_UNIX'):
+            if os.path.exists(sock_path):
+                os.unlink(sock_path)
+
+            self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.listener.bind(sock_path)
+            # Only the user running the scheduler can control it
+            os.chmod(sock_path, 0o600)
+            self.listener.listen()
+
+        self.thread = threading.Thread(target=self.serve, name='sched-control', daemon=True)
+        self.thread.start()
+
+    # Turn signals into control commands. Must be called from the main thread
+    def handle_signals(self, sig_cmds=None):
+        for signum, command in (sig_cmds or SIGNAL_COMMANDS).items():
+            signal.signal(signum, lambda *_, cmd=command: self.sig_send.send(cmd.encode() + b'\n'))
+            self.handled_signals.append(signum)
+
+    # Queue a command for the loop and wake it. Returns the reply to the sender
+    def post(self, line):
+        command = line.split()
+
+        if not command or command[0] not in CONTROL_COMMANDS:
+            return f"error: unknown command '{line.strip()}'. Use one of {CONTROL_COMMANDS}"
+
+        self.commands.put(command)
+        self.wake.set()
+
+        return 'ok'
+
+    # Control thread. Reads commands from the socket and from the signal handlers. Ends when the channel is closed
+    def serve(self):
+        sel = selectors.DefaultSelector()
+        sel.register(self.sig_recv, selectors.EVENT_READ)
+        if self.listener is not None:
+            sel.register(self.listener, selectors.EVENT_READ)
+
+        while True:
+            for key, _ in sel.select():
+                try:
+                    if key.fileobj is self.sig_recv:
+                        data = self.sig_recv.recv(4096)
+                        if not data:
+                            return
+                        for line in data.decode().splitlines():
+                            self.post(line)
+                    else:
+                        conn, _ = self.listener.accept()
+                        with conn:
+                            conn.settimeout(5)
+                            reply = self.post(conn.makefile().readline())
+                            conn.sendall(reply.encode() + b'\n')
+                except OSError as ex:
+                    # A client that went away doesn't stop the control thread
+                    print('Control channel error:', ex)
+
+    # Wait up to timeout seconds (for ever if None) for a command or a wake up. Returns the commands received
+    def wait(self, timeout=None):
+        self.wake.wait(timeout)
+        self.wake.clear()
+
+        commands = []
+        while not self.commands.empty():
+            commands.append(self.commands.get_nowait())
+
+        return commands
+
+    # Stop taking commands. The signals handled go back to their default handlers
+    def close(self):
+        for signum in self.handled_signals:
+            signal.signal(signum, signal.SIG_DFL)
+
+        # The control thread ends when the other end of the signal socket pair is closed
+        self.sig_send.close()
+        self.thread.join(5)
+        self.sig_recv.close()
+
+        if self.listener is not None:
+            self.listener.close()
+            if os.path.exists(self.sock_path):
+                os.unlink(self.sock_path)
+
+
+# Send a control command to a running scheduler and return its reply
+def send_control(sock_path, command):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.settimeout(5)
+        conn.connect(sock_path)
+        conn.sendall(command.encode() + b'\n')
+
+        return conn.makefile().readline().strip()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""secrets_cache.py: Cache secrets from AWS Secrets Manager for the scripts in this folder."""
+
+"""
+Every call to Secrets Manager creates a boto3 session and client and makes an API call. Scripts that need the
+same secret in several places (e.g. the Redshift credentials for the sqlalchemy engine, for deleting rows and
+for the COPY command) pay for that every time, and at high load frequency hit API throttling.
+
+get_secret keeps each secret in memory for a TTL, so it is fetched at most once per TTL per process. The cache
+is thread safe. The cache lock is only held to read and write the cache, never across the call to Secrets
+Manager, and threads that miss on the same secret at once wait on a lock of that secret for the one fetching
+it, so a slow fetch of one secret doesn't hold up the others. It is also safe across fork: a forked worker
+inherits the cached secrets without fetching them again, but gets a new lock and creates its own boto3
+clients, which can't be shared across processes. Secrets are never written to disk.
+
+Used by fast_save_df_to_redshift.py and python_scheduling.py.
+"""
+
+import os
+import json
+import threading
+import time
+import boto3
+
+from botocore.exceptions import ClientError
+
+__author__ = "Arindam Sinha"
+__license__ = "GPL"
+__version__ = "1.0.0"
+__status__ = "Prototype"
+
+# Seconds a secret is served from the cache before it is fetched again. Keep it below the rotation period
+DEFAULT_TTL = 300
+
+_cache = {}
+_clients = {}
+_cache_lock = threading.Lock()
+# Lock of each secret, held while it is fetched
+_secret_locks = {}
+
+
+# A lock held by another thread at the time of a fork would never be released in the child, and boto3 clients
+# can't be shared across processes. Cached secrets are kept
+def _reset_after_fork():
+    global _cache_lock
+
+    _cache_lock = threading.Lock()
+    _secret_locks.clear()
+    _clients.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+# Get the Secrets Manager client for a region, created once per process. Creating a client makes no network call
+def _get_client(region_name):
+    with _cache_lock:
+        if region_name not in _clients:
+            session = boto3.session.Session()
+            _clients[region_name] = session.client(
+                service_name='secretsmanager',
+                region_name=region_name
+            )
+
+        return _clients[region_name]
+
+
+# Get a secret from the cache if it hasn't expired, or None
+def _cached_secret(key):
+    with _cache_lock:
+        cached = _cache.get(key)
+
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+
+    return None
+
+
+# Get a secret as a dictionary. Served from the cache if it was fetched less than ttl seconds ago
+def get_secret(secret_name, region_name='us-west-2', ttl=DEFAULT_TTL):
+    key = (region_name, secret_name)
+
+    secret = _cached_secret(key)
+    if secret is not None:
+        return secret
+
+    with _cache_lock:
+        secret_lock = _secret_locks.setdefault(key, threading.Lock())
+
+    with secret_lock:
+        # Another thread may have fetched it while this one waited
+        secret = _cached_secret(key)
+        if secret is not None:
+            return secret
+
+        try:
+            get_secret_value_response = _get_client(region_name).get_secret_value(
+                SecretId=secret_name
+            )
+        except ClientError as e:
+            raise e
+
+        # Decrypts secret using the associated KMS key.
+        secret = json.loads(get_secret_value_response['SecretString'])
+        with _cache_lock:
+            _cache[key] = (secret, time.monotonic() + ttl)
+
+    return secret
+
+
+# Drop a secret from the cache, e.g. after a login fails because the secret was rotated. Drops all if no name
+def invalidate_secret(secret_name=None, region_name='us-west-2'):
+    with _cache_lock:
+        if secret_name is None:
+            _cache.clear()
+        else:
+            _cache.pop((region_name, secret_name), None)
@@ -1,7 +1,8 @@
-# This script shows two ways in which we can recursively find a hierarchy using a parent
-# child relationship between table columns. The two methods use (a) the START WITH...CONNECT BY
+# This script shows three ways in which we can find a hierarchy using a parent child
+# relationship between table columns. The first two recursively use (a) the START WITH...CONNECT BY
 # construct and (b) recursive CTE. Both methods should work in most modern databases
-# though the START WITH...CONNECT BY is not supported in all databases.
+# though the START WITH...CONNECT BY is not supported in all databases. The third, (c), joins
+# to a closure table materialized by hierarchy_engine.py, with no recursion.
 
 # Table used for this example (employee_dataset.csv) is in https://github.com/arindamsinha12/scripts/tree/main/data
 
@@ -35,4 +36,16 @@ WITH RECURSIVE supervisors
      )
 
  SELECT *
-   FROM supervisors;
\ No newline at end of file
+   FROM supervisors;
+
+# 3) Using a closure table
+# The closure table holds every (ancestor, descendant, distance) pair of the hierarchy. It is materialized and
+# bulk loaded by hierarchy_engine.py, so finding the hierarchy is a single indexed join with no recursion
+SELECT emp.employee_id, emp.employee_name, emp.supervisor_employee_id, sup.employee_name AS supervisor_name
+FROM testdb.testschema.employee_closure clo
+JOIN testdb.testschema.employee emp
+ON emp.employee_id = clo.descendant_id
+LEFT JOIN testdb.testschema.employee sup
+ON emp.supervisor_employee_id = sup.employee_id
+WHERE clo.ancestor_id = 1
+ORDER BY clo.distance;